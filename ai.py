@@ -0,0 +1,310 @@
+"""Асинхронный доступ к модели (GitHub Models / OpenAI-совместимый endpoint)."""
+import asyncio
+import functools
+import time
+from collections import deque
+
+import httpx
+from loguru import logger
+from openai import AsyncOpenAI
+
+from ratelimit import ModelQuota
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Служебные токены, которые модель добавляет к каждому сообщению чата.
+MESSAGE_OVERHEAD = 4
+# Приблизительная цена картинки (detail=high, одна плитка 512px + базовая часть).
+IMAGE_TOKENS = 255
+
+
+_encoding = None
+
+
+def load_tokenizer() -> bool:
+    """
+    Загружает словарь tiktoken (при первом запуске он скачивается — вызывать в отдельном потоке).
+    Пока словаря нет или загрузка не удалась, count_tokens считает приблизительно.
+    """
+    global _encoding
+    if tiktoken is None:
+        return False
+    for name in ("o200k_base", "cl100k_base"):
+        try:
+            _encoding = tiktoken.get_encoding(name)
+        except Exception as e:
+            logger.warning(f"Failed to load tiktoken encoding {name}: {e}")
+            continue
+        _prompt_tokens.cache_clear()
+        return True
+    return False
+
+
+def count_tokens(text) -> int:
+    """Число токенов в тексте: tiktoken, если словарь загружен (load_tokenizer), иначе грубая оценка ~4 символа на токен."""
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+_prompt_tokens = functools.lru_cache(maxsize=4)(count_tokens)
+
+
+SUMMARY_PROMPT = (
+    "Ты ведёшь краткий конспект переписки пользователя с ботом. "
+    "Объедини прежний конспект (если он есть) и новые сообщения в один конспект на русском языке: "
+    "факты о пользователе, его просьбы, договорённости и важные детали. "
+    "Пиши сжато, без HTML-разметки, не больше 15 пунктов."
+)
+
+
+DESCRIBE_PROMPT = (
+    "Подробно опиши изображение на русском языке: что на нём изображено, обстановку, людей, "
+    "эмоции, цвета и любые детали, которые могут понадобиться в разговоре о нём. "
+    "Если на изображении есть текст, перепиши его дословно. Без HTML-разметки."
+)
+
+
+def build_context(system_prompt: str, history: list, current, budget: int, current_tokens: int = None, summary: str = None):
+    """
+    Собирает сообщения для модели: системный промпт, конспект старой части
+    разговора, самые свежие сообщения истории, которые влезают в `budget`
+    токенов, и текущее сообщение.
+    Возвращает (messages, использовано_токенов).
+    """
+    if current_tokens is None:
+        current_tokens = count_tokens(current)
+    used = _prompt_tokens(system_prompt) + current_tokens + 2 * MESSAGE_OVERHEAD
+
+    head = [{"role": "system", "content": system_prompt}]
+    if summary:
+        summary_text = f"Краткое содержание предыдущей части разговора:\n{summary}"
+        head.append({"role": "system", "content": summary_text})
+        used += count_tokens(summary_text) + MESSAGE_OVERHEAD
+
+    selected = []
+    for message in reversed(history):
+        tokens = message.get("tokens")
+        if tokens is None:
+            tokens = count_tokens(message["content"])
+        cost = tokens + MESSAGE_OVERHEAD
+        if used + cost > budget:
+            break
+        selected.append({"role": message["role"], "content": message["content"]})
+        used += cost
+    selected.reverse()
+
+    return [*head, *selected, {"role": "user", "content": current}], used
+
+
+async def summarize(engine, previous: str, messages: list) -> str:
+    """Сворачивает прежний конспект и сообщения [(id, role, content), ...] в новый конспект."""
+    transcript = "\n".join(f"{role}: {content}" for _, role, content in messages)
+    request = f"Прежний конспект:\n{previous or '—'}\n\nНовые сообщения:\n{transcript}"
+    return await engine.complete([
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": request},
+    ])
+
+
+def image_part(image_data: str) -> dict:
+    """Часть сообщения с картинкой (base64 JPEG)."""
+    return {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_data}"}}
+
+
+async def describe_image(engine, image_data: str, caption: str = None, key=None) -> str:
+    """Текстовое описание картинки (base64 JPEG) для истории: в следующих ходах оно идёт в контекст вместо байтов."""
+    content = [image_part(image_data)]
+    if caption:
+        content.insert(0, {"type": "text", "text": f"Подпись пользователя (учти, о чём он спрашивает): {caption}"})
+    return await engine.complete([
+        {"role": "system", "content": DESCRIBE_PROMPT},
+        {"role": "user", "content": content},
+    ], key=key)
+
+
+class CompletionCancelled(Exception):
+    """Запрос к модели был отменён через `CompletionEngine.cancel`."""
+
+
+def estimate_tokens(messages: list) -> int:
+    """Оценка размера запроса в токенах (для квоты, когда build_context не посчитал его сам)."""
+    total = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, list):
+            for part in content:
+                total += count_tokens(part.get("text")) if part.get("type") == "text" else IMAGE_TOKENS
+        else:
+            total += count_tokens(content)
+        total += MESSAGE_OVERHEAD
+    return total
+
+
+class CompletionEngine:
+    """
+    Один AsyncOpenAI клиент на весь бот: общий пул соединений,
+    общая квота на endpoint (ModelQuota) и отмена запроса по ключу (chat_id).
+    """
+
+    def __init__(self, api_key: str, base_url: str, model: str, max_concurrency: int = 8, timeout: float = 30.0, quota: ModelQuota = None):
+        self.model = model
+        self.timeout = timeout
+        self.quota = quota or ModelQuota(max_concurrency)
+        max_concurrency = self.quota.max_concurrency
+        self._http = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency),
+            timeout=timeout,
+        )
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url, timeout=timeout, http_client=self._http)
+        self._inflight: dict = {}
+        self._cancelled: set = set()
+        self.requests = 0
+        self.failures = 0
+        self._latencies: deque = deque(maxlen=500)  # длительность последних успешных запросов, с
+
+    @property
+    def active(self) -> int:
+        """Сколько запросов с ключом сейчас выполняется или ждёт слота."""
+        return len(self._inflight)
+
+    def _record(self, started: float = None) -> None:
+        """Учитывает завершённый запрос; started=None — запрос упал."""
+        self.requests += 1
+        if started is None:
+            self.failures += 1
+        else:
+            self._latencies.append(time.monotonic() - started)
+
+    async def _create(self, messages: list, tokens: int, **kwargs) -> str:
+        async with self.quota.acquire(tokens):
+            started = time.monotonic()
+            try:
+                response = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    timeout=self.timeout,
+                    **kwargs,
+                )
+            except Exception:
+                self._record()
+                raise
+            self._record(started)
+        if response.usage is not None:
+            self.quota.record(response.usage.total_tokens - tokens)
+        return response.choices[0].message.content
+
+    def _track(self, key, task: asyncio.Future) -> None:
+        if key is not None:
+            self._inflight[key] = task
+
+    def _untrack(self, key, task: asyncio.Future) -> None:
+        self._cancelled.discard(task)
+        if key is not None and self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    async def complete(self, messages: list, key=None, tokens: int = None, **kwargs) -> str:
+        """
+        Выполняет запрос; при `cancel(key)` бросает CompletionCancelled.
+        `tokens` — размер запроса для квоты, если уже известен.
+        """
+        if tokens is None:
+            tokens = estimate_tokens(messages)
+        task = asyncio.ensure_future(self._create(messages, tokens, **kwargs))
+        self._track(key, task)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if task in self._cancelled:
+                raise CompletionCancelled(f"Completion for {key} was cancelled") from None
+            raise
+        finally:
+            self._untrack(key, task)
+
+    async def stream(self, messages: list, key=None, tokens: int = None, **kwargs):
+        """
+        Потоковый вариант `complete`: отдаёт куски текста по мере генерации.
+        Чтение ответа идёт в отдельной задаче, поэтому `cancel(key)` не убивает хендлер.
+        """
+        if tokens is None:
+            tokens = estimate_tokens(messages)
+        queue: asyncio.Queue = asyncio.Queue()
+
+        async def produce():
+            output = []
+            async with self.quota.acquire(tokens):
+                started = time.monotonic()
+                try:
+                    response = await self.client.chat.completions.create(
+                        model=self.model,
+                        messages=messages,
+                        timeout=self.timeout,
+                        stream=True,
+                        **kwargs,
+                    )
+                    async for chunk in response:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            output.append(chunk.choices[0].delta.content)
+                            queue.put_nowait(chunk.choices[0].delta.content)
+                except Exception:
+                    self._record()
+                    raise
+                self._record(started)
+            self.quota.record(count_tokens("".join(output)))
+
+        task = asyncio.ensure_future(produce())
+        task.add_done_callback(lambda _: queue.put_nowait(None))
+        self._track(key, task)
+        try:
+            while (delta := await queue.get()) is not None:
+                yield delta
+            if task.cancelled():
+                if task in self._cancelled:
+                    raise CompletionCancelled(f"Completion for {key} was cancelled")
+                raise asyncio.CancelledError()
+            task.result()
+        finally:
+            if not task.done():
+                task.cancel()
+            self._untrack(key, task)
+
+    def cancel(self, key) -> bool:
+        """Отменяет текущий запрос для ключа. True, если было что отменять."""
+        task = self._inflight.get(key)
+        if task is None or task.done():
+            return False
+        self._cancelled.add(task)
+        task.cancel()
+        return True
+
+    def reconfigure(self, base_url: str = None, model: str = None) -> None:
+        """
+        Меняет модель и/или endpoint на лету. Новый клиент использует тот же пул соединений,
+        уже начатые запросы доходят через прежний.
+        """
+        client = self.client.with_options(base_url=base_url) if base_url is not None else self.client
+        self.client = client
+        if model is not None:
+            self.model = model
+
+    def stats(self) -> dict:
+        """Число запросов и задержки модели (по последним успешным запросам)."""
+        latencies = sorted(self._latencies)
+        count = len(latencies)
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "avg": sum(latencies) / count if count else 0.0,
+            "p50": latencies[count // 2] if count else 0.0,
+            "p95": latencies[min(count - 1, int(count * 0.95))] if count else 0.0,
+        }
+
+    async def close(self) -> None:
+        for task in list(self._inflight.values()):
+            task.cancel()
+        await self.client.close()
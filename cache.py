@@ -0,0 +1,126 @@
+"""Кэши поверх базы бота: ответы модели, сгенерированные картинки и описания фото."""
+import hashlib
+import json
+import re
+import threading
+import time
+
+from database import Database
+
+_SPACES = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    return _SPACES.sub(" ", text or "").strip().casefold()
+
+
+class ResponseCache:
+    """
+    Кэш ответов модели в таблице response_cache.
+    Ключ — хэш всего запроса (модель и endpoint, системный промпт, обрезанный контекст, сообщение),
+    поэтому совпадают только действительно одинаковые запросы к той же модели.
+    """
+
+    def __init__(self, db: Database, ttl: int = 86400, max_entries: int = 5000):
+        self.db = db
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.saved_time = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(messages: list, model: str = "", endpoint: str = "") -> str:
+        normalized = [[model, endpoint], *([m["role"], normalize(m["content"])] for m in messages)]
+        return hashlib.sha256(json.dumps(normalized, ensure_ascii=False).encode()).hexdigest()
+
+    def get(self, key: str):
+        row = self.db.get_cached_response(key, int(time.time()) - self.ttl)
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.saved_time += row[1] or 0.0
+        return row[0]
+
+    def put(self, key: str, response: str, latency: float) -> None:
+        self.db.put_cached_response(key, response, latency, self.max_entries, int(time.time()) - self.ttl)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "saved_time": self.saved_time,
+            }
+
+
+class ImageCache:
+    """Нормализованный запрос /generate -> Telegram file_id первой отправленной картинки (LRU в таблице image_cache)."""
+
+    def __init__(self, db: Database, max_entries: int = 2000):
+        self.db = db
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, prompt: str):
+        file_id = self.db.get_image_file_id(normalize(prompt))
+        with self._lock:
+            if file_id is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return file_id
+
+    def put(self, prompt: str, file_id: str) -> None:
+        self.db.put_image_file_id(normalize(prompt), file_id, self.max_entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+class VisionCache:
+    """
+    Telegram file_unique_id фото -> текстовое описание от модели (LRU в таблице vision_cache).
+    Одно и то же фото (пересланный мем, скриншот) анализируется только один раз.
+    """
+
+    def __init__(self, db: Database, max_entries: int = 5000):
+        self.db = db
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, file_unique_id: str):
+        description = self.db.get_image_description(file_unique_id)
+        with self._lock:
+            if description is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return description
+
+    def put(self, file_unique_id: str, description: str) -> None:
+        self.db.put_image_description(file_unique_id, description, self.max_entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
@@ -0,0 +1,320 @@
+"""
+Многопроцессный режим (BOT_WORKERS > 1).
+
+Супервизор получает апдейты (long polling или webhook) и раздаёт их
+воркерам по `chat_id % workers`, поэтому все апдейты одного чата
+обрабатывает один и тот же процесс и в том же порядке. Воркеры
+обращаются к супервизору через очередь управления: остановка и
+перезапуск всего пула, рассылка событий остальным воркерам.
+"""
+import asyncio
+import multiprocessing
+import os
+import signal
+import sys
+
+from loguru import logger
+
+# Заполняются только внутри воркера
+_index = None
+_workers = None
+_control = None
+_broadcast_handlers: dict = {}
+
+_CHAT_FIELDS = (
+    "message", "edited_message", "channel_post", "edited_channel_post",
+    "my_chat_member", "chat_member", "chat_join_request",
+)
+_USER_FIELDS = ("inline_query", "chosen_inline_result", "shipping_query", "pre_checkout_query", "poll_answer")
+
+
+def is_worker() -> bool:
+    return _control is not None
+
+
+def is_primary() -> bool:
+    """Однопроцессный режим или первый воркер: здесь запускаются фоновые задачи, которые не нужно дублировать."""
+    return not _index
+
+
+def shard():
+    """(номер воркера, число воркеров) — чаты этого процесса: chat_id % число == номер. None в однопроцессном режиме."""
+    return (_index, _workers) if is_worker() else None
+
+
+def share(total: int) -> int:
+    """
+    Доля общего лимита на этот процесс: воркеры не общаются друг с другом,
+    поэтому лимит на всех делится поровну (не меньше 1; 0 — «без лимита» — не делится).
+    """
+    if not total or not is_worker():
+        return total
+    return max(1, total // _workers)
+
+
+def request(action: str) -> None:
+    """Просит супервизор остановить ("stop") или перезапустить ("restart") все процессы."""
+    _control.put(("request", _index, action, None))
+
+
+def broadcast(name: str, data=None) -> None:
+    """Отправляет событие остальным воркерам. В однопроцессном режиме ничего не делает."""
+    if is_worker():
+        _control.put(("broadcast", _index, name, data))
+
+
+def on_broadcast(name: str):
+    """Регистрирует обработчик события, присланного другим воркером через `broadcast`."""
+    def decorator(func):
+        _broadcast_handlers.setdefault(name, []).append(func)
+        return func
+    return decorator
+
+
+def chat_id_of(update: dict) -> int:
+    for field in _CHAT_FIELDS:
+        if field in update:
+            return update[field]["chat"]["id"]
+    if "callback_query" in update:
+        callback = update["callback_query"]
+        message = callback.get("message")
+        return message["chat"]["id"] if message else callback["from"]["id"]
+    for field in _USER_FIELDS:
+        if field in update:
+            user = update[field].get("from") or update[field].get("user")
+            if user:
+                return user["id"]
+    return 0
+
+
+# ===|Worker|===
+def _worker_main(index: int, workers: int, updates, control) -> None:
+    global _index, _workers, _control
+    _index, _workers, _control = index, workers, control
+    # Ctrl+C получает вся группа процессов; останавливает воркеры супервизор, чтобы они успели сбросить базу
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        asyncio.run(_worker(index, updates))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _feed(dp, bot, update: dict, previous, dispatched: asyncio.Event):
+    """
+    Порядок апдейтов одного чата соблюдается только до постановки в очередь:
+    апдейт ждёт, пока предыдущий дойдёт до ChatQueueMiddleware (или завершится),
+    а не пока закончится его хендлер. Поэтому сообщения склеиваются в пачки,
+    а /clear и отмена генерации не ждут ответа, который должны отменить.
+    """
+    if previous is not None:
+        await previous.wait()
+    try:
+        await dp.feed_raw_update(bot, update, dispatched=dispatched)
+    except Exception as e:
+        logger.exception(f"Worker {_index} failed to process update {update.get('update_id')}: {e}")
+    finally:
+        dispatched.set()
+
+
+async def _worker(index: int, updates) -> None:
+    from main import dp, bot, router
+    import handlers
+
+    dp.include_router(router)
+    await dp.emit_startup(bot=bot)
+    logger.info(f"Worker {index} started (pid {os.getpid()})")
+
+    loop = asyncio.get_running_loop()
+    chains: dict[int, asyncio.Event] = {}  # chat_id -> событие "последний апдейт чата поставлен в очередь"
+    tasks: set = set()
+
+    def release(chat_id, dispatched, task):
+        tasks.discard(task)
+        if chains.get(chat_id) is dispatched:
+            del chains[chat_id]
+
+    while True:
+        kind, payload = await loop.run_in_executor(None, updates.get)
+        if kind == "update":
+            chat_id, update = payload
+            dispatched = asyncio.Event()
+            task = asyncio.create_task(_feed(dp, bot, update, chains.get(chat_id), dispatched))
+            chains[chat_id] = dispatched
+            tasks.add(task)
+            task.add_done_callback(lambda t, c=chat_id, d=dispatched: release(c, d, t))
+        elif kind == "broadcast":
+            name, data = payload
+            for func in _broadcast_handlers.get(name, []):
+                try:
+                    result = func(data)
+                    if asyncio.iscoroutine(result):
+                        await result
+                except Exception as e:
+                    logger.exception(f"Worker {index} failed to handle broadcast {name}: {e}")
+        elif kind == "shutdown":
+            break
+
+    # дожидаемся начатых апдейтов (не дольше SHUTDOWN_TIMEOUT), затем сбрасываем базу и закрываем пулы
+    handlers.lifecycle.accepting = False
+    if tasks:
+        _, pending = await asyncio.wait(list(tasks), timeout=handlers.SHUTDOWN_TIMEOUT)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    await dp.emit_shutdown(bot=bot)
+    await dp.storage.close()
+    await handlers.lifecycle.stop()
+    await bot.session.close()
+    logger.info(f"Worker {index} stopped")
+
+
+# ===|Supervisor|===
+class Supervisor:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._ctx = multiprocessing.get_context("spawn")
+        self.control = self._ctx.Queue()
+        self.queues = [self._ctx.Queue() for _ in range(workers)]
+        self.processes = [None] * workers
+        self.stopping = False
+        self.action = None
+
+    def spawn(self, index: int) -> None:
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(index, self.workers, self.queues[index], self.control),
+            name=f"bot-worker-{index}",
+        )
+        process.start()
+        self.processes[index] = process
+
+    def route(self, update: dict) -> None:
+        chat_id = chat_id_of(update)
+        self.queues[chat_id % self.workers].put(("update", (chat_id, update)))
+
+    async def watch(self) -> None:
+        """Обрабатывает запросы воркеров и перезапускает упавшие процессы."""
+        loop = asyncio.get_running_loop()
+        while not self.stopping:
+            try:
+                message = await loop.run_in_executor(None, self.control.get, True, 1.0)
+            except Exception:
+                message = None
+            if message is not None:
+                kind, sender, name, data = message
+                if kind == "broadcast":
+                    for index, q in enumerate(self.queues):
+                        if index != sender:
+                            q.put(("broadcast", (name, data)))
+                elif kind == "request" and name in ("stop", "restart"):
+                    logger.info(f"Worker {sender} requested {name}")
+                    self.action = name
+                    self.stopping = True
+                    return
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.warning(f"Worker {index} exited with code {process.exitcode}, respawning")
+                    self.spawn(index)
+
+    def stop_workers(self, timeout: float = 30.0) -> None:
+        for q in self.queues:
+            q.put(("shutdown", None))
+        for index, process in enumerate(self.processes):
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"Worker {index} did not stop in {timeout}s, terminating")
+                process.terminate()
+
+
+async def _poll(supervisor: Supervisor, bot, allowed_updates, drop_pending: bool) -> None:
+    await bot.delete_webhook(drop_pending_updates=drop_pending)
+    offset = None
+    while not supervisor.stopping:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+        except Exception as e:
+            logger.exception(f"Failed to fetch updates: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            supervisor.route(update.model_dump(mode="json", exclude_none=True))
+            offset = update.update_id + 1
+
+
+async def _serve_webhook(supervisor: Supervisor, bot, allowed_updates) -> None:
+    from aiohttp import web
+    import main
+
+    async def receive(request: web.Request) -> web.Response:
+        if main.WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != main.WEBHOOK_SECRET:
+            return web.Response(status=401)
+        if supervisor.stopping:
+            # воркеры уже останавливаются: Telegram повторит апдейт после перезапуска
+            return web.Response(status=503)
+        supervisor.route(await request.json())
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(main.WEBHOOK_PATH, receive)
+    app.router.add_get("/health", main.health)
+    await bot.set_webhook(
+        main.WEBHOOK_URL.rstrip("/") + main.WEBHOOK_PATH,
+        secret_token=main.WEBHOOK_SECRET,
+        drop_pending_updates=main.DROP_PENDING_UPDATES,
+        allowed_updates=allowed_updates,
+    )
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host=main.WEBHOOK_HOST, port=main.WEBHOOK_PORT).start()
+    logger.info(f"Webhook server listening on {main.WEBHOOK_HOST}:{main.WEBHOOK_PORT}{main.WEBHOOK_PATH}")
+    try:
+        while not supervisor.stopping:
+            await asyncio.sleep(1)
+    finally:
+        await runner.cleanup()
+
+
+async def _supervise(supervisor: Supervisor) -> None:
+    import main
+
+    main.dp.include_router(main.router)
+    allowed_updates = main.dp.resolve_used_update_types()
+    for index in range(supervisor.workers):
+        supervisor.spawn(index)
+    logger.info(f"Supervisor started {supervisor.workers} workers ({main.BOT_MODE})")
+
+    def request_stop(sig):
+        logger.info(f"Supervisor received {sig.name}, stopping workers")
+        supervisor.stopping = True
+
+    # супервизор — PID 1 в Docker: без обработчика SIGTERM docker stop убьёт воркеры, не дав им сбросить базу
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, request_stop, sig)
+        except NotImplementedError:
+            pass  # Windows
+
+    if main.BOT_MODE == "webhook":
+        source = asyncio.create_task(_serve_webhook(supervisor, main.bot, allowed_updates))
+    else:
+        source = asyncio.create_task(_poll(supervisor, main.bot, allowed_updates, main.DROP_PENDING_UPDATES))
+    try:
+        await supervisor.watch()
+    finally:
+        supervisor.stopping = True
+        source.cancel()
+        await asyncio.gather(source, return_exceptions=True)
+        await main.bot.session.close()
+
+
+def run_supervisor(workers: int) -> None:
+    supervisor = Supervisor(workers)
+    try:
+        asyncio.run(_supervise(supervisor))
+    finally:
+        import handlers
+        # воркерам нужно время, чтобы дождаться своих ответов (SHUTDOWN_TIMEOUT) и сбросить базу
+        supervisor.stop_workers(timeout=handlers.SHUTDOWN_TIMEOUT + 15)
+    if supervisor.action == "restart":
+        os.execl(sys.executable, sys.executable, "-m", "start")
@@ -0,0 +1,116 @@
+"""
+Настройки, которые можно менять без перезапуска: prompt.txt и часть переменных из .env.
+
+Config — неизменяемый снимок. ConfigWatcher следит за временем изменения файлов,
+собирает новый снимок целиком и подменяет `current` одной операцией, так что
+хендлер, взявший снимок в начале запроса, до конца работает с согласованными значениями.
+"""
+import asyncio
+import os
+from dataclasses import dataclass, fields
+
+from dotenv import dotenv_values
+from loguru import logger
+
+DEFAULT_ENDPOINT = "https://models.github.ai/inference"
+DEFAULT_MODEL = "openai/gpt-4o-mini"
+
+
+@dataclass(frozen=True)
+class Config:
+    prompt: str
+    endpoint: str
+    model_name: str
+    rate_limit_seconds: float
+    rate_limit_burst: float
+    image_max_bytes: int
+
+
+def load(prompt_file: str = "prompt.txt", env_file: str = ".env") -> Config:
+    """Читает настройки. Значения из .env важнее окружения процесса, чтобы правка файла действовала и при перезагрузке."""
+    env = {**os.environ, **{k: v for k, v in dotenv_values(env_file).items() if v is not None}}
+    with open(prompt_file, "r", encoding="utf-8") as f:
+        prompt = f.read()
+    config = Config(
+        prompt=prompt,
+        endpoint=env.get("AI_ENDPOINT") or DEFAULT_ENDPOINT,
+        model_name=env.get("AI_MODEL") or DEFAULT_MODEL,
+        rate_limit_seconds=float(env.get("RATE_LIMIT_SECONDS", "2.0")),
+        rate_limit_burst=float(env.get("RATE_LIMIT_BURST", "3")),
+        image_max_bytes=int(env.get("IMAGE_MAX_BYTES", str(5 * 1024 * 1024))),
+    )
+    # проверяем здесь, чтобы on_change получал только то, что можно применить целиком
+    if not config.rate_limit_seconds > 0:
+        raise ValueError(f"RATE_LIMIT_SECONDS must be > 0, got {config.rate_limit_seconds}")
+    if not config.rate_limit_burst >= 1:
+        raise ValueError(f"RATE_LIMIT_BURST must be >= 1, got {config.rate_limit_burst}")
+    if config.image_max_bytes <= 0:
+        raise ValueError(f"IMAGE_MAX_BYTES must be > 0, got {config.image_max_bytes}")
+    return config
+
+
+class ConfigWatcher:
+    """
+    Держит текущий Config и перечитывает его, когда меняется prompt.txt или .env
+    (проверка раз в `interval` секунд) или по вызову `reload()`.
+    `on_change(old, new, changed)` применяет новые значения к уже созданным объектам:
+    сначала вычисляет всё, что может упасть, и только потом меняет объекты, — при ошибке
+    остаются и прежний снимок, и прежние объекты. Вызывать из event loop (как и хендлеры).
+    """
+
+    def __init__(self, on_change=None, prompt_file: str = "prompt.txt", env_file: str = ".env", interval: float = 5.0):
+        self.prompt_file = prompt_file
+        self.env_file = env_file
+        self.interval = interval
+        self.on_change = on_change
+        self.current = load(prompt_file, env_file)
+        self.reloads = 0
+        self._mtimes = self._stat()
+        self._task = None
+
+    def _stat(self) -> tuple:
+        mtimes = []
+        for path in (self.prompt_file, self.env_file):
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except FileNotFoundError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def reload(self) -> list[str]:
+        """Перечитывает настройки и возвращает имена изменившихся полей. При ошибке остаётся прежний снимок."""
+        self._mtimes = self._stat()
+        new = load(self.prompt_file, self.env_file)
+        old = self.current
+        changed = [f.name for f in fields(Config) if getattr(old, f.name) != getattr(new, f.name)]
+        if not changed:
+            return []
+        if self.on_change is not None:
+            self.on_change(old, new, changed)
+        self.current = new
+        self.reloads += 1
+        logger.info(f"Config reloaded, changed: {', '.join(changed)}")
+        return changed
+
+    def start(self) -> None:
+        if self._task is None and self.interval:
+            self._task = asyncio.create_task(self._watch())
+
+    async def _watch(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            if self._stat() == self._mtimes:
+                continue
+            try:
+                self.reload()
+            except Exception as e:
+                logger.exception(f"Failed to reload config: {e}")
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -1,90 +1,1030 @@
+import queue
 import sqlite3
 import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from loguru import logger
+
+PRAGMAS = (
+    # действует только на ещё пустую базу, поэтому идёт до journal_mode (см. Database.migrate)
+    "PRAGMA auto_vacuum = INCREMENTAL",
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 134217728",
+    "PRAGMA busy_timeout = 5000",
+)
+
+
+def _migration_1(cursor):
+    """Базовые таблицы (схема до версионирования)."""
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            role TEXT,
+            content TEXT
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS blacklist (
+            user_id INTEGER PRIMARY KEY
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS admins (
+            user_id INTEGER PRIMARY KEY
+        )
+        """
+    )
+
+
+def _migration_2(cursor):
+    """Индекс под get_history: поиск по user_id и сортировка по id без скана таблицы."""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_history_user_id ON history (user_id, id)")
+
+
+def _migration_3(cursor):
+    """Кэш числа токенов сообщения: считается один раз, при записи или первом чтении."""
+    cursor.execute("ALTER TABLE history ADD COLUMN tokens INTEGER")
+
+
+def _migration_4(cursor):
+    """Сжатое содержание старой части разговора (см. Database.save_summary)."""
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS summaries (
+            user_id INTEGER PRIMARY KEY,
+            content TEXT
+        )
+        """
+    )
+
+
+def _migration_5(cursor):
+    """Состояния FSM aiogram (см. storage.SQLiteStorage)."""
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS fsm (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT
+        )
+        """
+    )
+
+
+def _migration_6(cursor):
+    """Кэш ответов модели (см. cache.ResponseCache)."""
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            response TEXT,
+            latency REAL,
+            created_at INTEGER,
+            last_used INTEGER
+        )
+        """
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_last_used ON response_cache (last_used)")
+
+
+def _migration_7(cursor):
+    """Telegram file_id уже сгенерированных картинок по нормализованному запросу (см. cache.ImageCache)."""
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS image_cache (
+            prompt TEXT PRIMARY KEY,
+            file_id TEXT,
+            last_used INTEGER
+        )
+        """
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_image_cache_last_used ON image_cache (last_used)")
+
+
+def _migration_8(cursor):
+    """Описания фото от модели по Telegram file_unique_id (см. cache.VisionCache)."""
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS vision_cache (
+            file_unique_id TEXT PRIMARY KEY,
+            description TEXT,
+            last_used INTEGER
+        )
+        """
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vision_cache_last_used ON vision_cache (last_used)")
+
+
+def _migration_9(cursor):
+    """
+    Агрегаты для статистики, которые поддерживают триггеры на history:
+    сообщения по пользователям, общие счётчики и активность по дням.
+    Благодаря им Database.stats не сканирует history.
+    """
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id INTEGER PRIMARY KEY,
+            messages INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            last_active TEXT
+        )
+        """
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_stats_sent ON user_stats (sent)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS totals (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT PRIMARY KEY,
+            users INTEGER NOT NULL DEFAULT 0,
+            messages INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS daily_users (
+            day TEXT,
+            user_id INTEGER,
+            PRIMARY KEY (day, user_id)
+        ) WITHOUT ROWID
+        """
+    )
+
+    # messages — сколько строк пользователя сейчас в history, sent — сколько он написал за всё время
+    cursor.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS history_stats_insert AFTER INSERT ON history
+        BEGIN
+            INSERT OR IGNORE INTO user_stats (user_id) VALUES (NEW.user_id);
+            UPDATE user_stats SET
+                messages = messages + 1,
+                sent = sent + (NEW.role = 'user'),
+                last_active = CASE WHEN NEW.role = 'user' THEN date('now') ELSE last_active END
+            WHERE user_id = NEW.user_id;
+            UPDATE totals SET value = value + 1 WHERE name = 'messages';
+            UPDATE totals SET value = value + 1
+            WHERE name = 'users' AND (SELECT messages FROM user_stats WHERE user_id = NEW.user_id) = 1;
+            INSERT OR IGNORE INTO daily_stats (day) SELECT date('now') WHERE NEW.role = 'user';
+            UPDATE daily_stats SET messages = messages + 1 WHERE day = date('now') AND NEW.role = 'user';
+            INSERT OR IGNORE INTO daily_users (day, user_id) SELECT date('now'), NEW.user_id WHERE NEW.role = 'user';
+        END
+        """
+    )
+    # срабатывает только когда пользователь впервые пишет за день (INSERT OR IGNORE выше)
+    cursor.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS daily_users_insert AFTER INSERT ON daily_users
+        BEGIN
+            UPDATE daily_stats SET users = users + 1 WHERE day = NEW.day;
+        END
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS history_stats_delete AFTER DELETE ON history
+        BEGIN
+            UPDATE user_stats SET messages = messages - 1 WHERE user_id = OLD.user_id;
+            UPDATE totals SET value = value - 1 WHERE name = 'messages';
+            UPDATE totals SET value = value - 1
+            WHERE name = 'users' AND (SELECT messages FROM user_stats WHERE user_id = OLD.user_id) = 0;
+        END
+        """
+    )
+
+    # заполняем агрегаты по уже существующей истории
+    cursor.execute(
+        """
+        INSERT OR REPLACE INTO user_stats (user_id, messages, sent)
+        SELECT user_id, COUNT(*), SUM(role = 'user') FROM history GROUP BY user_id
+        """
+    )
+    cursor.execute(
+        """
+        INSERT OR REPLACE INTO totals (name, value) VALUES
+            ('messages', (SELECT COALESCE(SUM(messages), 0) FROM user_stats)),
+            ('users', (SELECT COUNT(*) FROM user_stats WHERE messages > 0))
+        """
+    )
+
+
+def _migration_10(cursor):
+    """Время записи сообщения (unix time) для политик хранения; старым строкам ставится время миграции."""
+    cursor.execute("ALTER TABLE history ADD COLUMN created_at INTEGER")
+    cursor.execute("UPDATE history SET created_at = strftime('%s', 'now')")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_history_created_at ON history (created_at)")
+
+
+def _migration_11(cursor):
+    """
+    Активность (sent, last_active, daily_*) считается только для свежих сообщений:
+    строки, возвращённые из архива (см. Database.restore_user), уже были учтены.
+    """
+    cursor.execute("DROP TRIGGER IF EXISTS history_stats_insert")
+    cursor.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS history_stats_insert AFTER INSERT ON history
+        BEGIN
+            INSERT OR IGNORE INTO user_stats (user_id) VALUES (NEW.user_id);
+            UPDATE user_stats SET messages = messages + 1 WHERE user_id = NEW.user_id;
+            UPDATE totals SET value = value + 1 WHERE name = 'messages';
+            UPDATE totals SET value = value + 1
+            WHERE name = 'users' AND (SELECT messages FROM user_stats WHERE user_id = NEW.user_id) = 1;
+        END
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS history_activity_insert AFTER INSERT ON history
+        WHEN NEW.role = 'user' AND NEW.created_at >= strftime('%s', 'now') - 3600
+        BEGIN
+            UPDATE user_stats SET sent = sent + 1, last_active = date('now') WHERE user_id = NEW.user_id;
+            INSERT OR IGNORE INTO daily_stats (day) VALUES (date('now'));
+            UPDATE daily_stats SET messages = messages + 1 WHERE day = date('now');
+            INSERT OR IGNORE INTO daily_users (day, user_id) VALUES (date('now'), NEW.user_id);
+        END
+        """
+    )
+
+
+def _migration_12(cursor):
+    """
+    history_activity_insert срабатывал раньше history_stats_insert и не находил строку
+    user_stats нового пользователя — первое сообщение не попадало в sent/last_active.
+    """
+    cursor.execute("DROP TRIGGER IF EXISTS history_activity_insert")
+    cursor.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS history_activity_insert AFTER INSERT ON history
+        WHEN NEW.role = 'user' AND NEW.created_at >= strftime('%s', 'now') - 3600
+        BEGIN
+            INSERT OR IGNORE INTO user_stats (user_id) VALUES (NEW.user_id);
+            UPDATE user_stats SET sent = sent + 1, last_active = date('now') WHERE user_id = NEW.user_id;
+            INSERT OR IGNORE INTO daily_stats (day) VALUES (date('now'));
+            UPDATE daily_stats SET messages = messages + 1 WHERE day = date('now');
+            INSERT OR IGNORE INTO daily_users (day, user_id) VALUES (date('now'), NEW.user_id);
+        END
+        """
+    )
+    # sent считается за всё время и не может быть меньше числа сообщений пользователя в истории
+    cursor.execute(
+        """
+        UPDATE user_stats SET sent = (
+            SELECT COUNT(*) FROM history WHERE history.user_id = user_stats.user_id AND role = 'user'
+        )
+        WHERE sent < (SELECT COUNT(*) FROM history WHERE history.user_id = user_stats.user_id AND role = 'user')
+        """
+    )
+    cursor.execute(
+        """
+        UPDATE user_stats SET last_active = (
+            SELECT date(MAX(created_at), 'unixepoch') FROM history
+            WHERE history.user_id = user_stats.user_id AND role = 'user'
+        )
+        WHERE last_active IS NULL
+        """
+    )
+
+
+# Версия схемы = количество применённых миграций (хранится в PRAGMA user_version).
+# Новые изменения схемы добавляются только в конец списка.
+MIGRATIONS = [
+    _migration_1,
+    _migration_2,
+    _migration_3,
+    _migration_4,
+    _migration_5,
+    _migration_6,
+    _migration_7,
+    _migration_8,
+    _migration_9,
+    _migration_10,
+    _migration_11,
+    _migration_12,
+]
+
+# Холодная история неактивных пользователей (отдельный файл, подключается как схема archive).
+# content хранится сжатым zlib, id совпадают с id в history.
+ARCHIVE_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS archive.history (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        role TEXT,
+        content BLOB,
+        tokens INTEGER,
+        created_at INTEGER
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_history_user_id ON history (user_id, id)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_history_created_at ON history (created_at)",
+    "CREATE TABLE IF NOT EXISTS archive.archived_users (user_id INTEGER PRIMARY KEY, archived_at INTEGER)",
+)
+
+# Префикс таблиц со стёртой историей, которые по частям дочищает maintenance.py
+WIPED_PREFIX = "history_wiped_"
+
+
+class HistoryCache:
+    """
+    LRU-кэш последних `depth` сообщений каждого пользователя и его конспекта (summaries).
+    Ограничен суммарным размером текста (`max_bytes`), а не числом чатов.
+    """
+
+    def __init__(self, depth=100, max_bytes=32 * 1024 * 1024):
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # user_id -> [messages, size, summary]
+        self._loading = {}  # user_id -> токен загрузки из базы
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _message_size(message) -> int:
+        return len(message["content"] or "")
+
+    def get(self, user_id, limit):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or limit > self.depth:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[0][-limit:] if limit else []
+
+    def get_summary(self, user_id):
+        """(True, конспект или None), если чат в кэше, иначе (False, None)."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return False, None
+            return True, entry[2]
+
+    def count(self, user_id):
+        """Точное число сообщений чата в истории, если чат в кэше целиком (их меньше `depth`), иначе None."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or len(entry[0]) >= self.depth:
+                return None
+            return len(entry[0])
+
+    def begin_load(self, user_id):
+        """Отмечает начало чтения из базы; запись во время чтения отменит кэширование."""
+        token = object()
+        with self._lock:
+            self._loading[user_id] = token
+        return token
+
+    def finish_load(self, user_id, token, messages, summary=None):
+        with self._lock:
+            if self._loading.get(user_id) is not token:
+                return
+            del self._loading[user_id]
+            self._drop(user_id)
+            messages = messages[-self.depth:]
+            size = sum(self._message_size(m) for m in messages) + len(summary or "")
+            self._entries[user_id] = [messages, size, summary]
+            self._size += size
+            self._evict()
+
+    def append(self, user_id, message):
+        with self._lock:
+            self._loading.pop(user_id, None)
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            entry[0].append(message)
+            added = self._message_size(message)
+            if len(entry[0]) > self.depth:
+                added -= self._message_size(entry[0].pop(0))
+            entry[1] += added
+            self._size += added
+            self._entries.move_to_end(user_id)
+            self._evict()
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._loading.pop(user_id, None)
+            self._drop(user_id)
+
+    def clear(self):
+        with self._lock:
+            self._loading.clear()
+            self._entries.clear()
+            self._size = 0
+
+    def _drop(self, user_id):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._size -= entry[1]
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self._size -= entry[1]
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "chats": len(self._entries),
+                "bytes": self._size,
+            }
+
 
 class Database:
-    def __init__(self, db_file):
-        self.connection = sqlite3.connect(db_file, check_same_thread=False)
+    """
+    Одно соединение на запись (под `_lock`) и пул соединений на чтение.
+    В WAL-режиме читатели не ждут писателя и друг друга.
+
+    Новые сообщения истории не пишутся сразу: они копятся в очереди и
+    сбрасываются одной транзакцией, когда набирается `batch_size` строк
+    или проходит `flush_interval` секунд.
+    """
+
+    def __init__(self, db_file, readers=4, batch_size=64, flush_interval=0.5, history_cache=None, token_counter=None,
+                 archive_file=None):
+        self.db_file = db_file
+        self.archive_file = archive_file
+        self.token_counter = token_counter
+        self.history_cache = history_cache or HistoryCache()
+        self.connection = self._connect()
         self._lock = threading.Lock()
-        self.create_table()
+        self.migrate()
+        self._archived = set(self._load_archived())  # пользователи, чья история лежит в архиве
+        self._readers = queue.Queue()
+        for _ in range(readers):
+            self._readers.put(self._connect())
 
-    def create_table(self):
-        with self._lock, self.connection:
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._unflushed = {}  # user_id -> сколько его строк ещё не закоммичено
+        self._pending_cond = threading.Condition()
+        self._closed = False
+        self._flusher = threading.Thread(target=self._flush_loop, name="db-flusher", daemon=True)
+        self._flusher.start()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_file, check_same_thread=False)
+        for pragma in PRAGMAS:
+            connection.execute(pragma)
+        if self.archive_file:
+            connection.execute("ATTACH DATABASE ? AS archive", (self.archive_file,))
+            connection.execute("PRAGMA archive.auto_vacuum = INCREMENTAL")
+            connection.execute("PRAGMA archive.journal_mode = WAL")
+            connection.execute("PRAGMA archive.synchronous = NORMAL")
+        return connection
+
+    @contextmanager
+    def _reader(self):
+        """Берёт свободное соединение на чтение из пула."""
+        connection = self._readers.get()
+        try:
+            yield connection.cursor()
+        finally:
+            self._readers.put(connection)
+
+    def _flush_loop(self):
+        while True:
+            with self._pending_cond:
+                if not self._closed and len(self._pending) < self.batch_size:
+                    self._pending_cond.wait(self.flush_interval)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(f"Failed to flush history batch: {e}")
+
+    def flush(self):
+        """Записывает накопленные сообщения одной транзакцией."""
+        with self._lock:
+            with self._pending_cond:
+                rows, self._pending = self._pending, []
+            if not rows:
+                return
+            try:
+                with self.connection:
+                    self.connection.executemany(
+                        "INSERT INTO history (user_id, role, content, tokens, created_at) VALUES (?, ?, ?, ?, ?)",
+                        rows
+                    )
+            except Exception:
+                with self._pending_cond:
+                    self._pending[:0] = rows
+                raise
+            with self._pending_cond:
+                for user_id, *_ in rows:
+                    left = self._unflushed[user_id] - 1
+                    if left:
+                        self._unflushed[user_id] = left
+                    else:
+                        del self._unflushed[user_id]
+
+    def _flush_user(self, user_id):
+        """Сбрасывает очередь, если в ней есть строки этого пользователя."""
+        with self._pending_cond:
+            dirty = user_id in self._unflushed
+        if dirty:
+            self.flush()
+
+    def close(self):
+        """Сбрасывает очередь записи и закрывает все соединения."""
+        with self._pending_cond:
+            self._closed = True
+            self._pending_cond.notify()
+        self._flusher.join()
+        self.flush()
+        with self._lock:
+            self.connection.close()
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+
+    def migrate(self):
+        """Применяет недостающие миграции, каждую в своей транзакции."""
+        with self._lock:
             cursor = self.connection.cursor()
-            cursor.execute(
-                """
-                CREATE TABLE IF NOT EXISTS history (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    role TEXT,
-                    content TEXT
-                )
-                """
-            )
-            cursor.execute(
-                """
-                CREATE TABLE IF NOT EXISTS blacklist (
-                    user_id INTEGER PRIMARY KEY
-                )
-                """
-            )
-            cursor.execute(
-                """
-                CREATE TABLE IF NOT EXISTS admins (
-                    user_id INTEGER PRIMARY KEY
-                )
-                """
-            )
+            version = cursor.execute("PRAGMA user_version").fetchone()[0]
+            # incremental_vacuum (см. maintenance.py) работает только при auto_vacuum = INCREMENTAL;
+            # пустой базе режим ставится сразу (см. PRAGMAS), базу с таблицами (в том числе
+            # созданную до версионирования, с user_version = 0) один раз перестраиваем VACUUM'ом
+            if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                if cursor.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0]:
+                    logger.info("Rebuilding database to enable incremental vacuum, this may take a while")
+                    cursor.execute("VACUUM")
+            for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                cursor.execute("BEGIN")
+                try:
+                    migration(cursor)
+                    cursor.execute(f"PRAGMA user_version = {number}")
+                    cursor.execute("COMMIT")
+                except Exception:
+                    cursor.execute("ROLLBACK")
+                    raise
+                logger.info(f"Database migrated to schema v{number}")
+            if self.archive_file:
+                with self.connection:
+                    for statement in ARCHIVE_SCHEMA:
+                        cursor.execute(statement)
+
+    def _load_archived(self):
+        if not self.archive_file:
+            return []
+        with self._lock:
+            rows = self.connection.execute("SELECT user_id FROM archive.archived_users").fetchall()
+            return [row[0] for row in rows]
+
+    def _count_tokens(self, content):
+        return self.token_counter(content) if self.token_counter else None
 
     def add_message(self, user_id, role, content):
-        """Сохраняет сообщение в базу."""
-        with self._lock, self.connection:
-            cursor = self.connection.cursor()
-            cursor.execute(
-                "INSERT INTO history (user_id, role, content) VALUES (?, ?, ?)",
-                (user_id, role, content)
-            )
+        """Ставит сообщение в очередь на запись в базу."""
+        tokens = self._count_tokens(content)
+        with self._pending_cond:
+            self._pending.append((user_id, role, content, tokens, int(time.time())))
+            self._unflushed[user_id] = self._unflushed.get(user_id, 0) + 1
+            self.history_cache.append(user_id, {"role": role, "content": content, "tokens": tokens})
+            if len(self._pending) >= self.batch_size:
+                self._pending_cond.notify()
+
     def get_history(self, user_id, limit=40):
         """
-        Получает историю и форматирует её для OpenAI.
+        Получает историю в формате OpenAI (role/content) с числом токенов каждого сообщения.
+        Активные чаты читаются из HistoryCache, база — только при промахе.
         """
-        with self._lock:
-            cursor = self.connection.cursor()
+        cached = self.history_cache.get(user_id, limit)
+        if cached is not None:
+            return cached
+
+        token = self.history_cache.begin_load(user_id)
+        if user_id in self._archived:
+            self.restore_user(user_id)
+        self._flush_user(user_id)
+        with self._reader() as cursor:
             cursor.execute(
-                "SELECT role, content FROM history WHERE user_id = ? ORDER BY id DESC LIMIT ?",
-                (user_id, limit)
+                "SELECT id, role, content, tokens FROM history WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+                (user_id, max(limit, self.history_cache.depth))
             )
             rows = cursor.fetchall()
+            # конспект кэшируется вместе с историей; save_summary и clear_history сбрасывают обе части
+            summary = cursor.execute("SELECT content FROM summaries WHERE user_id = ?", (user_id,)).fetchone()
         
         messages = []
-        for row in reversed(rows):
-            # Формат OpenAI - просто {'role': ROLE, 'content': CONTENT}
+        counted = []
+        for row_id, role, content, tokens in reversed(rows):
+            if tokens is None and self.token_counter:
+                tokens = self._count_tokens(content)
+                counted.append((tokens, row_id))
+            # Формат OpenAI - {'role': ROLE, 'content': CONTENT} + число токенов для сборки контекста
             messages.append({
-                "role": row[0],
-                "content": row[1] 
+                "role": role,
+                "content": content,
+                "tokens": tokens,
             })
-        return messages
+        if counted:
+            with self._lock, self.connection:
+                self.connection.executemany("UPDATE history SET tokens = ? WHERE id = ?", counted)
+        self.history_cache.finish_load(user_id, token, messages, summary[0] if summary else None)
+        return messages[-limit:] if limit else []
 
     # ... (метод clear_history, get_stats и т.д.)
     def clear_history(self, user_id):
         """Очистка истории пользователя."""
+        self.flush()
         with self._lock, self.connection:
             cursor = self.connection.cursor()
             cursor.execute("DELETE FROM history WHERE user_id = ?", (user_id,))
+            cursor.execute("DELETE FROM summaries WHERE user_id = ?", (user_id,))
+            if self.archive_file:
+                self._archived.discard(user_id)
+                cursor.execute("DELETE FROM archive.history WHERE user_id = ?", (user_id,))
+                cursor.execute("DELETE FROM archive.archived_users WHERE user_id = ?", (user_id,))
+        self.history_cache.invalidate(user_id)
 
     def clear_global_history(self):
-        """Удаляет всю историю"""
+        """
+        Удаляет всю историю. Сама таблица не чистится: она переименовывается в
+        history_wiped_*, на её месте создаётся пустая с той же схемой, а старые
+        строки по частям удаляет purge_wiped (см. maintenance.py).
+        """
+        self.flush()
         with self._lock, self.connection:
             cursor = self.connection.cursor()
-            cursor.execute("DELETE FROM history")
-            cursor.execute("VACUUM")
+            cursor.execute("BEGIN IMMEDIATE")
+            schema = cursor.execute(
+                """
+                SELECT type, name, sql FROM sqlite_master
+                WHERE tbl_name = 'history' AND sql IS NOT NULL
+                ORDER BY type = 'table' DESC
+                """
+            ).fetchall()
+            wiped = f"{WIPED_PREFIX}{time.time_ns()}"
+            cursor.execute(f"ALTER TABLE history RENAME TO {wiped}")
+            # индексы и триггеры переехали вместе с таблицей, а их имена нужны новой
+            for kind, name, _ in schema:
+                if kind in ("index", "trigger"):
+                    cursor.execute(f"DROP {kind.upper()} {name}")
+            for _, _, sql in schema:
+                cursor.execute(sql)
+            # id продолжаются с того же места, что и в стёртой таблице
+            cursor.execute(
+                "INSERT INTO sqlite_sequence (name, seq) SELECT 'history', seq FROM sqlite_sequence WHERE name = ?",
+                (wiped,)
+            )
+            if self.archive_file:
+                archive_wiped = f"{WIPED_PREFIX}{time.time_ns()}"
+                cursor.execute(f"ALTER TABLE archive.history RENAME TO {archive_wiped}")
+                cursor.execute("DROP INDEX archive.idx_archive_history_user_id")
+                cursor.execute("DROP INDEX archive.idx_archive_history_created_at")
+                for statement in ARCHIVE_SCHEMA:
+                    cursor.execute(statement)
+                cursor.execute("DELETE FROM archive.archived_users")
+                self._archived.clear()
+            cursor.execute("DELETE FROM summaries")
+            cursor.execute("UPDATE user_stats SET messages = 0 WHERE messages != 0")
+            cursor.execute("UPDATE totals SET value = 0 WHERE name IN ('messages', 'users')")
+        self.history_cache.clear()
+
+    def _schemas(self):
+        return ("main", "archive") if self.archive_file else ("main",)
+
+    def wiped_tables(self) -> list[str]:
+        """Таблицы стёртой истории (schema.name), которые ещё не дочищены."""
+        tables = []
+        with self._reader() as cursor:
+            for schema in self._schemas():
+                rows = cursor.execute(
+                    f"SELECT name FROM {schema}.sqlite_master WHERE type = 'table' AND name LIKE ?", (f"{WIPED_PREFIX}%",)
+                ).fetchall()
+                tables += [f"{schema}.{row[0]}" for row in rows]
+        return tables
+
+    def purge_wiped(self, table, chunk_size) -> int:
+        """Удаляет до `chunk_size` строк стёртой истории; пустую таблицу удаляет совсем. Возвращает число строк."""
+        schema, name = table.split(".")
+        with self._lock, self.connection:
+            cursor = self.connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            # таблицу мог уже дочистить другой процесс
+            exists = cursor.execute(
+                f"SELECT 1 FROM {schema}.sqlite_master WHERE type = 'table' AND name = ?", (name,)
+            ).fetchone()
+            if not exists:
+                return 0
+            cursor.execute(f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} LIMIT ?)", (chunk_size,))
+            deleted = cursor.rowcount
+            if deleted < chunk_size:
+                cursor.execute(f"DROP TABLE {table}")
+            return deleted
+
+    def _delete_history_rows(self, rows) -> int:
+        """Удаляет строки [(id, user_id), ...] и сбрасывает кэш истории их владельцев."""
+        with self._lock, self.connection:
+            self.connection.executemany("DELETE FROM history WHERE id = ?", [(row_id,) for row_id, _ in rows])
+        for user_id in {user_id for _, user_id in rows}:
+            self.history_cache.invalidate(user_id)
+        return len(rows)
+
+    def _delete_archived_rows(self, rows) -> int:
+        """Удаляет строки [(id,), ...] из архива; кэш не трогаем — архивных пользователей в нём нет."""
+        with self._lock, self.connection:
+            self.connection.executemany("DELETE FROM archive.history WHERE id = ?", rows)
+        return len(rows)
+
+    @staticmethod
+    def _shard_filter(shard):
+        """
+        Условие на user_id для shard=(index, count) — те же чаты, что supervisor отдаёт воркеру
+        (chat_id % count == index по правилам Python, то есть и для отрицательных id).
+        """
+        if not shard:
+            return "", ()
+        index, count = shard
+        return " AND ((user_id % ?) + ?) % ? = ?", (count, count, count, index)
+
+    def delete_expired(self, before, chunk_size, shard=None) -> int:
+        """
+        Удаляет до `chunk_size` сообщений, записанных раньше `before` (unix time).
+        shard — только чаты этого воркера: кэш истории сбрасывается в том процессе, который им пользуется.
+        """
+        where, params = self._shard_filter(shard)
+        with self._reader() as cursor:
+            rows = cursor.execute(
+                f"SELECT id, user_id FROM history WHERE created_at < ?{where} ORDER BY created_at LIMIT ?",
+                (before, *params, chunk_size)
+            ).fetchall()
+        deleted = self._delete_history_rows(rows)
+        if self.archive_file and deleted < chunk_size:
+            # архив живёт по тем же правилам хранения, created_at переносится вместе со строкой
+            with self._reader() as cursor:
+                archived = cursor.execute(
+                    f"SELECT id FROM archive.history WHERE created_at < ?{where} ORDER BY created_at LIMIT ?",
+                    (before, *params, chunk_size - deleted)
+                ).fetchall()
+            deleted += self._delete_archived_rows(archived)
+        return deleted
+
+    def trim_users(self, max_rows, chunk_size, shard=None) -> int:
+        """
+        Удаляет до `chunk_size` самых старых сообщений у пользователей, у которых их больше `max_rows`.
+        shard — как в delete_expired.
+        """
+        where, params = self._shard_filter(shard)
+        rows = []
+        with self._reader() as cursor:
+            users = cursor.execute(
+                f"SELECT user_id, messages - ? FROM user_stats WHERE messages > ?{where}", (max_rows, max_rows, *params)
+            ).fetchall()
+            for user_id, excess in users:
+                if len(rows) >= chunk_size:
+                    break
+                rows += cursor.execute(
+                    "SELECT id, user_id FROM history WHERE user_id = ? ORDER BY id LIMIT ?",
+                    (user_id, min(excess, chunk_size - len(rows)))
+                ).fetchall()
+        deleted = self._delete_history_rows(rows)
+        if self.archive_file and deleted < chunk_size:
+            archived = []
+            with self._reader() as cursor:
+                users = cursor.execute(f"SELECT user_id FROM archive.archived_users WHERE 1{where}", params).fetchall()
+                for (user_id,) in users:
+                    if deleted + len(archived) >= chunk_size:
+                        break
+                    excess = cursor.execute(
+                        "SELECT COUNT(*) FROM archive.history WHERE user_id = ?", (user_id,)
+                    ).fetchone()[0] - max_rows
+                    if excess > 0:
+                        archived += cursor.execute(
+                            "SELECT id FROM archive.history WHERE user_id = ? ORDER BY id LIMIT ?",
+                            (user_id, min(excess, chunk_size - deleted - len(archived)))
+                        ).fetchall()
+            deleted += self._delete_archived_rows(archived)
+        return deleted
 
-    def stats(self):
-        """Возвращает статистику по базе"""
+    def prune_daily_users(self, before_day) -> int:
+        """Удаляет списки активных пользователей за дни раньше `before_day` (YYYY-MM-DD); daily_stats остаётся."""
+        with self._lock, self.connection:
+            return self.connection.execute("DELETE FROM daily_users WHERE day < ?", (before_day,)).rowcount
+
+    def incremental_vacuum(self, pages) -> int:
+        """Возвращает файлам до `pages` свободных страниц. Возвращает, сколько свободных страниц осталось."""
+        free = 0
         with self._lock:
+            for schema in self._schemas():
+                self.connection.execute(f"PRAGMA {schema}.incremental_vacuum({int(pages)})").fetchall()
+                free += self.connection.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0]
+        return free
+
+    # ===|Архив|===
+    def inactive_users(self, before, limit, shard=None) -> list[int]:
+        """
+        До `limit` пользователей с историей, которые ничего не писали с `before` (unix time).
+        shard=(index, count) — только чаты, которые supervisor отдаёт этому воркеру (chat_id % count == index):
+        несброшенные строки других процессов отсюда не видны, поэтому каждый архивирует только своих.
+        """
+        before_day = time.strftime("%Y-%m-%d", time.gmtime(before))
+        with self._pending_cond:
+            busy = set(self._unflushed)
+        users = []
+        with self._reader() as cursor:
+            candidates = cursor.execute(
+                "SELECT user_id FROM user_stats WHERE messages > 0 AND (last_active IS NULL OR last_active < ?)",
+                (before_day,)
+            ).fetchall()
+            for (user_id,) in candidates:
+                if len(users) >= limit:
+                    break
+                if user_id in busy or (shard and user_id % shard[1] != shard[0]):
+                    continue
+                # last_active пуст у строк до появления статистики — смотрим на последнее сообщение
+                last = cursor.execute(
+                    "SELECT created_at FROM history WHERE user_id = ? ORDER BY id DESC LIMIT 1", (user_id,)
+                ).fetchone()
+                if last and last[0] is not None and last[0] < before:
+                    users.append(user_id)
+        return users
+
+    def archive_user(self, user_id, chunk_size) -> int:
+        """
+        Переносит историю пользователя в архив порциями по `chunk_size` строк.
+        Останавливается, если пользователь вернулся (restore_user). Возвращает число строк.
+        """
+        with self._lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO archive.archived_users (user_id, archived_at) VALUES (?, strftime('%s', 'now'))",
+                (user_id,)
+            )
+            self._archived.add(user_id)
+        self.history_cache.invalidate(user_id)
+
+        moved = 0
+        while True:
+            with self._lock, self.connection:
+                with self._pending_cond:
+                    busy = user_id in self._unflushed
+                # пользователь написал, пока шёл перенос — уже перенесённое вернёт restore_user
+                if user_id not in self._archived or busy:
+                    return moved
+                cursor = self.connection.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                rows = cursor.execute(
+                    "SELECT id, user_id, role, content, tokens, created_at FROM history WHERE user_id = ? ORDER BY id LIMIT ?",
+                    (user_id, chunk_size)
+                ).fetchall()
+                # в WAL-режиме коммит двух файлов не атомарен, поэтому перенос идемпотентный:
+                # строка, попавшая в обе базы, при восстановлении просто пропускается
+                cursor.executemany(
+                    "INSERT OR REPLACE INTO archive.history (id, user_id, role, content, tokens, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (row_id, uid, role, zlib.compress(content.encode()) if content is not None else None, tokens, created_at)
+                        for row_id, uid, role, content, tokens, created_at in rows
+                    ]
+                )
+                cursor.executemany("DELETE FROM history WHERE id = ?", [(row[0],) for row in rows])
+            moved += len(rows)
+            if len(rows) < chunk_size:
+                return moved
+
+    def restore_user(self, user_id) -> int:
+        """Возвращает историю пользователя из архива в history. Возвращает число строк."""
+        with self._lock, self.connection:
+            self._archived.discard(user_id)
+            cursor = self.connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            rows = cursor.execute(
+                "SELECT id, user_id, role, content, tokens, created_at FROM archive.history WHERE user_id = ?", (user_id,)
+            ).fetchall()
+            cursor.executemany(
+                "INSERT OR IGNORE INTO history (id, user_id, role, content, tokens, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (row_id, uid, role, zlib.decompress(content).decode() if content is not None else None, tokens, created_at)
+                    for row_id, uid, role, content, tokens, created_at in rows
+                ]
+            )
+            cursor.execute("DELETE FROM archive.history WHERE user_id = ?", (user_id,))
+            cursor.execute("DELETE FROM archive.archived_users WHERE user_id = ?", (user_id,))
+        if rows:
+            logger.debug(f"Restored {len(rows)} archived messages for {user_id}")
+        return len(rows)
+
+    def mark_archived(self, user_ids) -> None:
+        """Отмечает пользователей, которых заархивировал другой процесс."""
+        self._archived.update(user_ids)
+        for user_id in user_ids:
+            self.history_cache.invalidate(user_id)
+
+    def count_messages(self, user_id) -> int:
+        """
+        Сколько сообщений пользователя лежит в истории. Вызывается после каждого ответа,
+        поэтому очередь записи не сбрасывает: несохранённые строки досчитываются из памяти.
+        """
+        cached = self.history_cache.count(user_id)
+        if cached is not None:
+            return cached
+        with self._pending_cond:
+            unflushed = self._unflushed.get(user_id, 0)
+        with self._reader() as cursor:
+            res = cursor.execute("SELECT messages FROM user_stats WHERE user_id = ?", (user_id,)).fetchone()
+        return (res[0] if res else 0) + unflushed
+
+    def get_summarizable(self, user_id, keep, limit=200, max_tokens=None) -> list:
+        """
+        Старейшие сообщения пользователя, кроме последних `keep`, не больше `limit` штук
+        и не больше `max_tokens` токенов (по колонке tokens; хотя бы одно сообщение отдаётся всегда).
+        Возвращает [(id, role, content), ...] по возрастанию id.
+        """
+        self._flush_user(user_id)
+        with self._reader() as cursor:
+            rows = cursor.execute(
+                """
+                SELECT id, role, content, tokens FROM history
+                WHERE user_id = ? AND id <= (
+                    SELECT id FROM history WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?
+                )
+                ORDER BY id LIMIT ?
+                """,
+                (user_id, user_id, keep, limit)
+            ).fetchall()
+        selected = []
+        used = 0
+        for row_id, role, content, tokens in rows:
+            if max_tokens is not None:
+                if tokens is None:
+                    tokens = self._count_tokens(content) or 0
+                used += tokens
+                if selected and used > max_tokens:
+                    break
+            selected.append((row_id, role, content))
+        return selected
+
+    def get_summary(self, user_id):
+        """Сохранённое содержание старой части разговора или None."""
+        cached, summary = self.history_cache.get_summary(user_id)
+        if cached:
+            return summary
+        with self._reader() as cursor:
+            res = cursor.execute("SELECT content FROM summaries WHERE user_id = ?", (user_id,)).fetchone()
+            return res[0] if res else None
+
+    def save_summary(self, user_id, content, upto_id) -> bool:
+        """
+        Сохраняет новое содержание и удаляет вошедшие в него сообщения (id <= upto_id).
+        Если этих сообщений уже нет (историю стёрли, пока шло сворачивание), ничего не пишет и возвращает False.
+        """
+        with self._lock, self.connection:
             cursor = self.connection.cursor()
-            user_count = cursor.execute("SELECT COUNT(DISTINCT user_id) FROM history").fetchone()[0]
-            messages_count = cursor.execute("SELECT COUNT(*) FROM history").fetchone()[0]
-            return user_count, messages_count
+            if cursor.execute("SELECT 1 FROM history WHERE id = ? AND user_id = ?", (upto_id, user_id)).fetchone() is None:
+                return False
+            cursor.execute("INSERT OR REPLACE INTO summaries (user_id, content) VALUES (?, ?)", (user_id, content))
+            cursor.execute("DELETE FROM history WHERE user_id = ? AND id <= ?", (user_id, upto_id))
+        self.history_cache.invalidate(user_id)
+        return True
+
+    def stats(self, days=7, top=5) -> dict:
+        """
+        Статистика по базе из агрегатных таблиц (см. _migration_9):
+        users/messages — сейчас в истории, daily — [(день, пользователей, сообщений)] за `days` дней,
+        top — [(user_id, сообщений за всё время)] самых активных, archived — пользователей в архиве.
+        """
+        self.flush()
+        with self._reader() as cursor:
+            totals = dict(cursor.execute("SELECT name, value FROM totals").fetchall())
+            archived = 0
+            if self.archive_file:
+                archived = cursor.execute("SELECT COUNT(*) FROM archive.archived_users").fetchone()[0]
+            daily = cursor.execute(
+                "SELECT day, users, messages FROM daily_stats ORDER BY day DESC LIMIT ?", (days,)
+            ).fetchall()
+            top_users = cursor.execute(
+                "SELECT user_id, sent FROM user_stats WHERE sent > 0 ORDER BY sent DESC LIMIT ?", (top,)
+            ).fetchall()
+        return {
+            "users": totals.get("users", 0),
+            "messages": totals.get("messages", 0),
+            "daily": daily,
+            "top": top_users,
+            "archived": archived,
+        }
         
     def add_blacklist(self, user_id: int):
         """Добавить пользователя в ЧС"""
@@ -100,10 +1040,22 @@ class Database:
             cursor.execute("DELETE FROM blacklist WHERE user_id = ?", (user_id,))
             self.connection.commit()
 
+    def import_blacklist(self, user_ids) -> None:
+        """Добавить в ЧС сразу несколько пользователей"""
+        with self._lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO blacklist (user_id) VALUES (?)", [(user_id,) for user_id in user_ids]
+            )
+
+    def get_blacklist(self) -> list[int]:
+        """Список пользователей в ЧС"""
+        with self._reader() as cursor:
+            rows = cursor.execute("SELECT user_id FROM blacklist").fetchall()
+            return [row[0] for row in rows]
+
     def is_blacklisted(self, user_id: int) -> bool:
         """Проверить, забанен ли пользователь (True/False)"""
-        with self._lock:
-            cursor = self.connection.cursor()
+        with self._reader() as cursor:
             res = cursor.execute("SELECT 1 FROM blacklist WHERE user_id = ?", (user_id,)).fetchone()
             return bool(res)
 
@@ -123,14 +1075,124 @@ class Database:
 
     def get_admins(self) -> list[int]:
         """Список администраторов"""
-        with self._lock:
-            cursor = self.connection.cursor()
+        with self._reader() as cursor:
             rows = cursor.execute("SELECT user_id FROM admins").fetchall()
             return [row[0] for row in rows]
 
     def is_admin(self, user_id: int) -> bool:
         """Проверить, админ ли пользователь"""
-        with self._lock:
-            cursor = self.connection.cursor()
+        with self._reader() as cursor:
             res = cursor.execute("SELECT 1 FROM admins WHERE user_id = ?", (user_id,)).fetchone()
             return bool(res)
+
+    def get_fsm(self, key: str):
+        """Состояние и данные FSM (data — JSON-строка) или None."""
+        with self._reader() as cursor:
+            return cursor.execute("SELECT state, data FROM fsm WHERE key = ?", (key,)).fetchone()
+
+    def set_fsm_state(self, key: str, state) -> None:
+        with self._lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO fsm (key, state) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET state = excluded.state",
+                (key, state)
+            )
+
+    def set_fsm_data(self, key: str, data: str) -> None:
+        with self._lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO fsm (key, data) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET data = excluded.data",
+                (key, data)
+            )
+
+    def get_cached_response(self, key: str, not_before: int):
+        """(ответ, задержка оригинального запроса) или None, если записи нет или она старше not_before."""
+        with self._reader() as cursor:
+            row = cursor.execute(
+                "SELECT response, latency FROM response_cache WHERE key = ? AND created_at >= ?",
+                (key, not_before)
+            ).fetchone()
+        if row:
+            with self._lock, self.connection:
+                self.connection.execute(
+                    "UPDATE response_cache SET last_used = strftime('%s', 'now') WHERE key = ?", (key,)
+                )
+        return row
+
+    def put_cached_response(self, key: str, response: str, latency: float, max_entries: int, not_before: int) -> None:
+        """Сохраняет ответ и вытесняет устаревшие и давно не использованные записи."""
+        with self._lock, self.connection:
+            cursor = self.connection.cursor()
+            cursor.execute(
+                """
+                INSERT OR REPLACE INTO response_cache (key, response, latency, created_at, last_used)
+                VALUES (?, ?, ?, strftime('%s', 'now'), strftime('%s', 'now'))
+                """,
+                (key, response, latency)
+            )
+            cursor.execute("DELETE FROM response_cache WHERE created_at < ?", (not_before,))
+            cursor.execute(
+                """
+                DELETE FROM response_cache WHERE key IN (
+                    SELECT key FROM response_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (max_entries,)
+            )
+
+    def get_image_file_id(self, prompt: str):
+        """file_id картинки для запроса или None."""
+        with self._reader() as cursor:
+            row = cursor.execute("SELECT file_id FROM image_cache WHERE prompt = ?", (prompt,)).fetchone()
+        if row:
+            with self._lock, self.connection:
+                self.connection.execute(
+                    "UPDATE image_cache SET last_used = strftime('%s', 'now') WHERE prompt = ?", (prompt,)
+                )
+        return row[0] if row else None
+
+    def put_image_file_id(self, prompt: str, file_id: str, max_entries: int) -> None:
+        """Запоминает file_id и вытесняет давно не использованные записи сверх max_entries."""
+        with self._lock, self.connection:
+            cursor = self.connection.cursor()
+            cursor.execute(
+                "INSERT OR REPLACE INTO image_cache (prompt, file_id, last_used) VALUES (?, ?, strftime('%s', 'now'))",
+                (prompt, file_id)
+            )
+            cursor.execute(
+                """
+                DELETE FROM image_cache WHERE prompt IN (
+                    SELECT prompt FROM image_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (max_entries,)
+            )
+
+    def get_image_description(self, file_unique_id: str):
+        """Описание фото или None."""
+        with self._reader() as cursor:
+            row = cursor.execute(
+                "SELECT description FROM vision_cache WHERE file_unique_id = ?", (file_unique_id,)
+            ).fetchone()
+        if row:
+            with self._lock, self.connection:
+                self.connection.execute(
+                    "UPDATE vision_cache SET last_used = strftime('%s', 'now') WHERE file_unique_id = ?", (file_unique_id,)
+                )
+        return row[0] if row else None
+
+    def put_image_description(self, file_unique_id: str, description: str, max_entries: int) -> None:
+        """Запоминает описание фото и вытесняет давно не использованные записи сверх max_entries."""
+        with self._lock, self.connection:
+            cursor = self.connection.cursor()
+            cursor.execute(
+                "INSERT OR REPLACE INTO vision_cache (file_unique_id, description, last_used) VALUES (?, ?, strftime('%s', 'now'))",
+                (file_unique_id, description)
+            )
+            cursor.execute(
+                """
+                DELETE FROM vision_cache WHERE file_unique_id IN (
+                    SELECT file_unique_id FROM vision_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (max_entries,)
+            )
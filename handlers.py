@@ -3,21 +3,29 @@ from aiogram.filters import Command, CommandObject
 import json
 import html
 import os
-import sys
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from dotenv import load_dotenv
 import asyncio
 from loguru import logger
 import utils
+import cluster
 import time
 import datetime
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from database import Database
-from openai import OpenAI, OpenAIError
-import base64
-import io
-import aiohttp
+from database import Database, HistoryCache
+from cache import ImageCache, ResponseCache, VisionCache
+from middlewares import ChatQueueMiddleware
+from lifecycle import Lifecycle
+from config import ConfigWatcher
+from ratelimit import ModelQuota, TokenBucketLimiter
+from maintenance import Maintenance
+from images import ImageClient, ImageJob, ImageJobQueue, ImageTooLarge, QueueFull, pick_photo_size, prepare_photo
+from openai import OpenAIError
+from ai import (
+    IMAGE_TOKENS, SUMMARY_PROMPT, CompletionEngine, CompletionCancelled, build_context, count_tokens, describe_image,
+    image_part, load_tokenizer, summarize
+)
 import urllib.parse
 
 class UserMode(StatesGroup):
@@ -39,17 +47,79 @@ router = Router()
 
 load_dotenv()
 gpt_token = os.getenv("COPILOT_API_KEY")
-endpoint = "https://models.github.ai/inference"
-model_name = "openai/gpt-4o-mini"
 bot = Bot(os.getenv("BOT_TOKEN"))
 
-client = OpenAI(api_key=gpt_token, base_url=endpoint, timeout=30.0)
 
-with open("prompt.txt", "r", encoding="utf-8") as f:
-    prompt = f.read()
-
-
-db = Database('memory.db')
+def apply_config(old, new, changed):
+    """Переносит изменённые настройки на уже созданные объекты (см. config.py)."""
+    rate = 1 / new.rate_limit_seconds
+    if "endpoint" in changed or "model_name" in changed:
+        engine.reconfigure(base_url=new.endpoint if "endpoint" in changed else None, model=new.model_name)
+    limiter.rate, limiter.capacity = rate, new.rate_limit_burst
+
+
+# prompt.txt, модель, endpoint, лимит частоты и размер фото перечитываются без перезапуска
+CONFIG_WATCH_INTERVAL = float(os.getenv("CONFIG_WATCH_INTERVAL", "5"))
+config = ConfigWatcher(on_change=apply_config, interval=CONFIG_WATCH_INTERVAL)
+
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "8"))
+AI_TOKENS_PER_MINUTE = int(os.getenv("AI_TOKENS_PER_MINUTE", "0"))
+AI_STREAMING = os.getenv("AI_STREAMING", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+AI_CONTEXT_TOKENS = int(os.getenv("AI_CONTEXT_TOKENS", "6000"))
+# когда в истории больше SUMMARY_AFTER сообщений, всё кроме последних SUMMARY_KEEP сворачивается в конспект
+SUMMARY_AFTER = int(os.getenv("SUMMARY_AFTER", "60"))
+SUMMARY_KEEP = int(os.getenv("SUMMARY_KEEP", "20"))
+CHAT_COALESCE_SECONDS = float(os.getenv("CHAT_COALESCE_SECONDS", "0"))
+
+router.message.middleware(ChatQueueMiddleware(coalesce_window=CHAT_COALESCE_SECONDS))
+
+# лимиты общие на бота: в многопроцессном режиме каждый воркер получает свою долю
+model_quota = ModelQuota(cluster.share(AI_MAX_CONCURRENCY), tokens_per_minute=cluster.share(AI_TOKENS_PER_MINUTE))
+engine = CompletionEngine(gpt_token, config.current.endpoint, config.current.model_name, timeout=30.0, quota=model_quota)
+
+
+# сколько секунд /stop и /restart ждут уже начатые ответы и генерации
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "30"))
+lifecycle = Lifecycle(drain_timeout=SHUTDOWN_TIMEOUT)
+
+HISTORY_CACHE_MB = int(os.getenv("HISTORY_CACHE_MB", "32"))
+
+db = Database(
+    'memory.db',
+    history_cache=HistoryCache(max_bytes=HISTORY_CACHE_MB * 1024 * 1024),
+    token_counter=count_tokens,
+    archive_file='memory_archive.db',
+)
+
+# фоновая дочистка истории и политики хранения (0 — без ограничения)
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "0"))
+HISTORY_MAX_ROWS_PER_USER = int(os.getenv("HISTORY_MAX_ROWS_PER_USER", "0"))
+MAINTENANCE_INTERVAL = float(os.getenv("MAINTENANCE_INTERVAL", "3600"))
+# история тех, кто молчит дольше, уезжает в memory_archive.db и возвращается при следующем сообщении
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+maintenance = Maintenance(
+    db,
+    interval=MAINTENANCE_INTERVAL,
+    retention_days=HISTORY_RETENTION_DAYS,
+    max_rows_per_user=HISTORY_MAX_ROWS_PER_USER,
+    archive_after_days=ARCHIVE_AFTER_DAYS,
+    on_archived=lambda user_ids: cluster.broadcast("history_archived", user_ids),
+    scheduled=cluster.is_primary(),
+    shard=cluster.shard(),
+)
+
+# кэш одинаковых запросов к ИИ (RESPONSE_CACHE=1), картинки не кэшируются
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "86400"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "5000"))
+
+response_cache = ResponseCache(db, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_SIZE) if RESPONSE_CACHE else None
+IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", "2000"))
+image_cache = ImageCache(db, max_entries=IMAGE_CACHE_SIZE)
+# описания фото по file_unique_id: повторное фото не качается и не анализируется заново
+VISION_CACHE_SIZE = int(os.getenv("VISION_CACHE_SIZE", "5000"))
+vision_cache = VisionCache(db, max_entries=VISION_CACHE_SIZE)
 
 # я, саня, саша 
 master = [1078401181, 8386113624, 5802369201, 1131150026]
@@ -59,27 +129,101 @@ for admin_id in master:
 
 admin_cache = set(db.get_admins())
 
-RATE_LIMIT_SECONDS = 2.0
-IMAGE_MAX_BYTES = 5 * 1024 * 1024
 
-last_request_at: dict[str, float] = {}
+def import_fb_blacklist(path: str = "fb_blacklist.json") -> None:
+    """Разовый перенос старого ЧС фидбека из json в таблицу blacklist (файл после этого переименовывается)."""
+    if not os.path.exists(path):
+        return
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            blocked = [int(user_id) for user_id in json.load(f).get("blocked", [])]
+        db.import_blacklist(blocked)
+        os.replace(path, f"{path}.imported")
+        logger.info(f"Imported {len(blocked)} users from {path} into the blacklist table")
+    except FileNotFoundError:
+        # файл уже перенёс другой воркер
+        pass
+    except Exception as e:
+        logger.exception(f"Failed to import {path}: {e}")
+
+
+import_fb_blacklist()
+blacklist_cache = set(db.get_blacklist())
+
+# до какого размера (длинная сторона, px) ужимать фото перед отправкой модели
+IMAGE_TARGET_SIZE = int(os.getenv("IMAGE_TARGET_SIZE", "800"))
+GENERATED_IMAGE_MAX_BYTES = 10 * 1024 * 1024
+# сколько картинок генерируется одновременно и сколько может ждать в очереди
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+IMAGE_QUEUE_SIZE = int(os.getenv("IMAGE_QUEUE_SIZE", "20"))
+
+image_client = ImageClient(timeout=30, max_bytes=GENERATED_IMAGE_MAX_BYTES)
+
+# в среднем один запрос раз в RATE_LIMIT_SECONDS, но до RATE_LIMIT_BURST подряд
+limiter = TokenBucketLimiter(rate=1 / config.current.rate_limit_seconds, capacity=config.current.rate_limit_burst)
+
+
+@cluster.on_broadcast("admin_added")
+def _on_admin_added(user_id: int):
+    admin_cache.add(user_id)
+
+
+@cluster.on_broadcast("admin_removed")
+def _on_admin_removed(user_id: int):
+    admin_cache.discard(user_id)
+
+
+@cluster.on_broadcast("blacklist_added")
+def _on_blacklist_added(user_id: int):
+    blacklist_cache.add(user_id)
+
+
+@cluster.on_broadcast("blacklist_removed")
+def _on_blacklist_removed(user_id: int):
+    blacklist_cache.discard(user_id)
+
+
+@cluster.on_broadcast("history_archived")
+def _on_history_archived(user_ids: list[int]):
+    db.mark_archived(user_ids)
+
+
+@cluster.on_broadcast("config_reloaded")
+def _on_config_reloaded(_):
+    config.reload()
+
+
+@cluster.on_broadcast("history_wiped")
+def _on_history_wiped(_):
+    db.history_cache.clear()
 
 
 def is_admin(user_id: int) -> bool:
     return user_id in admin_cache
 
 
+def is_blacklisted(user_id: int) -> bool:
+    return user_id in blacklist_cache
+
+
+async def add_blacklist(user_id: int) -> None:
+    await asyncio.to_thread(db.add_blacklist, user_id)
+    blacklist_cache.add(user_id)
+    cluster.broadcast("blacklist_added", user_id)
+
+
+async def remove_blacklist(user_id: int) -> None:
+    await asyncio.to_thread(db.remove_blacklist, user_id)
+    blacklist_cache.discard(user_id)
+    cluster.broadcast("blacklist_removed", user_id)
+
+
 def h(text: str) -> str:
     return html.escape(text or "")
 
 
-def rate_limit(key: str, interval_seconds: float = RATE_LIMIT_SECONDS) -> bool:
-    now = time.monotonic()
-    last = last_request_at.get(key, 0.0)
-    if now - last < interval_seconds:
-        return False
-    last_request_at[key] = now
-    return True
+def rate_limit(key: str) -> bool:
+    return limiter.hit(key)
 
 
 def is_private_message(message: types.Message) -> bool:
@@ -90,45 +234,142 @@ def is_private_callback(callback: types.CallbackQuery) -> bool:
     return callback.message is not None and getattr(callback.message.chat, "type", None) == "private"
 
 
+async def on_startup():
+    await asyncio.to_thread(load_tokenizer)
+    await image_client.start()
+    image_jobs.start()
+    maintenance.start()
+    config.start()
+
+
+@lifecycle.on_close
+async def close_resources():
+    await engine.close()
+    await image_jobs.close()
+    await image_client.close()
+    await maintenance.close()
+    await config.close()
+    await bot.session.close()
+    db.close()
+
+
+async def shutdown(restart: bool = False):
+    if cluster.is_worker():
+        # в многопроцессном режиме останавливает/перезапускает весь пул супервизор
+        cluster.request("restart" if restart else "stop")
+        return
+    # дожидается начатых ответов, сбрасывает базу и только потом выходит (см. lifecycle.py)
+    lifecycle.request(restart)
+
+
 # ===|Copilot interaction|===
-async def ask_copilot(chat_id: int, user_message: str, image_data: str = None):
-    HISTORY_LIMIT = 40
+def photo_turn(description: str, caption: str) -> str:
+    """Как сообщение с фото хранится в истории: описание картинки вместо самих байтов."""
+    question = caption if caption else 'Что на изображении?'
+    return f"[Photo: {description}] {question}" if description else f"[Photo] {question}"
+
+
+def describe_key(chat_id: int):
+    """Ключ запроса описания фото в CompletionEngine: отдельный от ответа, но отменяется вместе с ним."""
+    return ("describe", chat_id)
+
+
+async def describe_photo(chat_id: int, photo_id: str, image_data: str, caption: str) -> str:
+    """Описывает новое фото и кладёт описание в vision_cache."""
+    description = await describe_image(engine, image_data, caption=caption, key=describe_key(chat_id))
+    if description:
+        await asyncio.to_thread(vision_cache.put, photo_id, description)
+    return description
 
-    db_text = f"[Photo] {user_message}" if image_data else user_message
-    await asyncio.to_thread(db.add_message, chat_id, "user", db_text) 
+
+async def remember_photo(chat_id: int, caption: str, describing: asyncio.Future) -> bool:
+    """Записывает в историю ход с фото, когда готово его описание. False — описание отменили, ничего не записано."""
+    try:
+        description = await describing
+    except CompletionCancelled:
+        # /clear или отмена ответа: ход не записываем, история могла быть уже стёрта
+        return False
+    except Exception as e:
+        logger.warning(f"Failed to describe photo for {chat_id}: {e}")
+        description = None
+    db.add_message(chat_id, "user", photo_turn(description, caption))
+    return True
+
+
+async def ask_copilot(chat_id: int, user_message: str, image_description: str = None, on_chunk=None,
+                      image_data: str = None, image_id: str = None):
+    """
+    image_description — описание фото из vision_cache: модель получает его текстом.
+    image_data/image_id — новое фото (base64 JPEG и file_unique_id): модель видит саму картинку,
+    а описание для истории и vision_cache готовится параллельно с ответом.
+    """
+    HISTORY_LIMIT = 100
+
+    # история читается до записи текущего сообщения, иначе оно попадёт в контекст дважды
     history = await asyncio.to_thread(db.get_history, chat_id, limit=HISTORY_LIMIT)
-    final_messages = [
-        {"role": "system", "content": prompt}
-    ]
-    final_messages.extend(history)
-    
-    if image_data:
-        current_content = [
-            {"type": "text", "text": user_message if user_message else "Что на изображении?"},
-            {
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:image/jpeg;base64,{image_data}"
-                }
-            }
-        ]
+    summary = await asyncio.to_thread(db.get_summary, chat_id)
+
+    describing = None
+    current_tokens = None
+    if image_data is not None:
+        question = user_message if user_message else 'Что на изображении?'
+        current_content = [{"type": "text", "text": question}, image_part(image_data)]
+        current_tokens = count_tokens(question) + IMAGE_TOKENS
+        describing = asyncio.ensure_future(describe_photo(chat_id, image_id, image_data, user_message))
+    elif image_description is not None:
+        current_content = photo_turn(image_description, user_message)
     else:
         current_content = user_message
 
-    final_messages.append({"role": "user", "content": current_content})
-    
-    try:
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=final_messages,
-            timeout=30.0,
-        )
-        
-        reply_content = response.choices[0].message.content
+    final_messages, context_tokens = build_context(
+        config.current.prompt, history, current_content, AI_CONTEXT_TOKENS, current_tokens=current_tokens, summary=summary
+    )
+    used_history = len(final_messages) - 2 - bool(summary)
+    logger.debug(f"Context for {chat_id}: {used_history}/{len(history)} history messages, summary: {bool(summary)}, ~{context_tokens} tokens")
+
+    if describing is None:
+        db.add_message(chat_id, "user", current_content)
+
+    cache_key = None
+    if response_cache is not None and image_description is None and image_data is None:
+        # после смены AI_MODEL/AI_ENDPOINT (см. apply_config) ответы прежней модели не отдаются
+        cache_key = ResponseCache.key(final_messages, model=engine.model, endpoint=str(engine.client.base_url))
+        cached = await asyncio.to_thread(response_cache.get, cache_key)
+        if cached is not None:
+            logger.debug(f"Response cache hit for {chat_id}")
+            db.add_message(chat_id, "assistant", cached)
+            return cached
 
-        await asyncio.to_thread(db.add_message, chat_id, "assistant", reply_content)
+    try:
+        started = time.monotonic()
+        if on_chunk is None:
+            reply_content = await engine.complete(final_messages, key=chat_id, tokens=context_tokens)
+        else:
+            parts = []
+            async for delta in engine.stream(final_messages, key=chat_id, tokens=context_tokens):
+                parts.append(delta)
+                await on_chunk(delta)
+            reply_content = "".join(parts)
+
+        if describing is not None:
+            # ход с фото попадает в историю раньше ответа на него
+            remembered = await remember_photo(chat_id, user_message, describing)
+            describing = None
+            if not remembered:
+                return reply_content
+        db.add_message(chat_id, "assistant", reply_content)
+        if cache_key is not None and reply_content:
+            await asyncio.to_thread(response_cache.put, cache_key, reply_content, time.monotonic() - started)
+        schedule_summary(chat_id)
         return reply_content
-        
+
+    except CompletionCancelled:
+        logger.debug(f"Completion for {chat_id} was cancelled")
+        if describing is not None:
+            describing.cancel()
+            describing = None
+        return "<a href='tg://emoji?id=5879995903955179148'>🛑</a> Запрос отменён."
+
     except OpenAIError as e:
         logger.exception(f"OpenAI/Copilot API Error for {chat_id}: {e}")
         return f"<a href='tg://emoji?id=5872829476143894491'>🐛</a> <b>Критическая ошибка в ИИ, сообщите о ней администрации</b> (/admins)\n\n<blockquote expandable><code>{e}</code></blockquote>"
@@ -137,19 +378,54 @@ async def ask_copilot(chat_id: int, user_message: str, image_data: str = None):
         logger.exception(f"Critical error in ask_copilot (non-API) for {chat_id}: {e}")
         return f"<a href='tg://emoji?id=5872829476143894491'>🐛</a> <b>Критическая ошибка в ИИ, сообщите о ней администрации</b> (/admins)\n\n<blockquote expandable><code>{e}</code></blockquote>"
 
+    finally:
+        if describing is not None:
+            await remember_photo(chat_id, user_message, describing)
 
-# сука его тоже в дб надо записывать а не жсон
-if not os.path.exists("fb_blacklist.json"):
-    with open("fb_blacklist.json", "w", encoding="utf-8") as f:
-        f.write('{"blocked": []}')
 
-def get_fb_blacklist():
-    with open("fb_blacklist.json", "r", encoding="utf-8") as f:
-        return json.load(f)["blocked"]
-    
-def save_fb_blacklist(lst):
-    with open("fb_blacklist.json", "w", encoding="utf-8") as f:
-        json.dump({"blocked": lst}, f, indent=4)
+_summary_tasks: dict[int, asyncio.Task] = {}
+
+
+async def summarize_history(chat_id: int):
+    """Сворачивает старые сообщения чата в конспект и удаляет их из истории."""
+    if await asyncio.to_thread(db.count_messages, chat_id) <= SUMMARY_AFTER:
+        return
+    previous = await asyncio.to_thread(db.get_summary, chat_id)
+    # запрос на сворачивание должен влезть в тот же бюджет, что и обычный контекст;
+    # остальное свернётся следующими проходами
+    budget = AI_CONTEXT_TOKENS - count_tokens(previous) - count_tokens(SUMMARY_PROMPT)
+    rows = await asyncio.to_thread(db.get_summarizable, chat_id, SUMMARY_KEEP, max_tokens=budget)
+    if not rows:
+        return
+    summary = await summarize(engine, previous, rows)
+    if not summary:
+        return
+    if not await asyncio.to_thread(db.save_summary, chat_id, summary, rows[-1][0]):
+        logger.debug(f"History of {chat_id} changed during summarization, summary dropped")
+        return
+    logger.debug(f"Summarized {len(rows)} messages for {chat_id}")
+
+
+def schedule_summary(chat_id: int):
+    """Запускает сворачивание истории в фоне, не больше одной задачи на чат."""
+    if chat_id in _summary_tasks:
+        return
+
+    async def run():
+        try:
+            await summarize_history(chat_id)
+        except Exception as e:
+            logger.exception(f"Failed to summarize history for {chat_id}: {e}")
+        finally:
+            _summary_tasks.pop(chat_id, None)
+
+    _summary_tasks[chat_id] = asyncio.create_task(run())
+
+
+@lifecycle.on_drain
+async def drain_summaries():
+    await asyncio.gather(*_summary_tasks.values(), return_exceptions=True)
+
 
 # ===|Handlers|===
 @router.message(Command("start")) 
@@ -180,7 +456,11 @@ async def clear(message: types.Message):
         return
     u = utils.user(message)
     logger.debug(f"@{u.username} [{u.id}] requested memory clear")
-    db.clear_history(u.id)
+    engine.cancel(u.id)
+    engine.cancel(describe_key(u.id))
+    if u.id in _summary_tasks:
+        _summary_tasks[u.id].cancel()
+    await asyncio.to_thread(db.clear_history, u.id)
     await message.answer("<a href='tg://emoji?id=5811966564039135541'>🧽</a> Memory cleared.", parse_mode="HTML")
 
 
@@ -193,8 +473,7 @@ async def stop(message: types.Message):
         logger.debug(f"You ({u.username}) stopped the bot. (stop command)")
         await message.answer("<a href='tg://emoji?id=5879995903955179148'>🛑</a> Bot stopped.\n\n<b>Check the panel</b>", parse_mode="HTML")
 
-        await bot.session.close()
-        os._exit(0)
+        await shutdown()
     else:
         logger.critical(f"@{u.username} / {u.id} tried to stop the bot without permission.")
         await message.reply("You don't have permission to use this command.")
@@ -226,6 +505,7 @@ async def ap(message: types.Message):
             ],
             [
                 InlineKeyboardButton(text="📂 Logs", callback_data="ap_logs"),
+                InlineKeyboardButton(text="🔁 Reload Config", callback_data="ap_reload"),
                 InlineKeyboardButton(text="🛑 Stop Bot", callback_data="ap_stop"),
                 InlineKeyboardButton(text="🔄️ Restart Bot", callback_data="ap_restart")
             ]
@@ -275,7 +555,7 @@ async def toggle_mode(message: types.Message, state: FSMContext):
     current = await state.get_state()
 
     if current == UserMode.ai.state:
-        if await asyncio.to_thread(db.is_blacklisted, utils.user(message).id):
+        if is_blacklisted(utils.user(message).id):
             await state.set_state(UserMode.ai)
             return await message.answer("<a href='tg://emoji?id=5922712343011135025'>🚫</a> Вы были заблокированы в фидбеке.", parse_mode="HTML")
             
@@ -333,7 +613,7 @@ async def fb_block(callback: types.CallbackQuery):
         await callback.answer("Нет прав.", show_alert=True)
         return
     target_id = int(callback.data.split("_")[2])
-    await asyncio.to_thread(db.add_blacklist, target_id)
+    await add_blacklist(target_id)
     await bot.send_message(target_id, f"<a href='tg://emoji?id=5922712343011135025'>🚫</a> Вы были заблокированы в фидбеке.", parse_mode="HTML")
     await callback.answer("🚫 Пользователь был заблокирован в фидбеке.")
     nt = f"{callback.message.text}\n\n<b>======[<a href='tg://emoji?id=5208972891055473699'>⛔️</a> ЗАБАНЕН]======</b>"
@@ -357,11 +637,11 @@ async def fb_unban(message: types.Message, command: CommandObject):
     except ValueError:
         return await message.answer("<a href='tg://emoji?id=6019102674832595118'>⚠️</a> ID должен быть числом.", parse_mode="HTML")
 
-    is_banned = await asyncio.to_thread(db.is_blacklisted, target_id)
+    is_banned = is_blacklisted(target_id)
 
     if is_banned:
         try:
-            await asyncio.to_thread(db.remove_blacklist, target_id)
+            await remove_blacklist(target_id)
             await message.answer("<a href='tg://emoji?id=5906995262378741881'>💖</a> Пользователь был разбанен.", parse_mode="HTML")
             await bot.send_message(target_id, "Вы были разбанены в фидбеке.", parse_mode="HTML")
         except Exception as e:
@@ -389,13 +669,13 @@ async def fb_ban(message: types.Message, command: CommandObject):
     except ValueError:
         return await message.answer("<a href='tg://emoji?id=6019102674832595118'>⚠️</a> ID должен быть числом.", parse_mode="HTML")
 
-    is_banned = await asyncio.to_thread(db.is_blacklisted, target_id)
+    is_banned = is_blacklisted(target_id)
 
     if is_banned:
         await message.answer("<a href='tg://emoji?id=6019102674832595118'>⚠️</a> Пользователь уже был забанен.")
     else:
         try:
-            await asyncio.to_thread(db.add_blacklist, target_id)
+            await add_blacklist(target_id)
             await message.answer("<a href='tg://emoji?id=5922712343011135025'>🚫</a> Пользователь был забанен.")
             await bot.send_message(target_id, "<a href='tg://emoji?id=5922712343011135025'>🚫</a> Вы были заблокированы в фидбеке.", parse_mode="HTML")
         except Exception as e:
@@ -424,6 +704,7 @@ async def add_admin_wait(message: types.Message, state: FSMContext):
 
     await asyncio.to_thread(db.add_admin, target_id)
     admin_cache.add(target_id)
+    cluster.broadcast("admin_added", target_id)
     await message.answer("<a href='tg://emoji?id=5906995262378741881'>💖</a> Админ добавлен.", parse_mode="HTML")
     await state.clear()
 
@@ -459,6 +740,7 @@ async def remove_admin_wait(message: types.Message, state: FSMContext):
 
     await asyncio.to_thread(db.remove_admin, target_id)
     admin_cache.discard(target_id)
+    cluster.broadcast("admin_removed", target_id)
     await message.answer("<a href='tg://emoji?id=5906995262378741881'>💖</a> Админ удалён.", parse_mode="HTML")
     await state.clear()
 
@@ -479,42 +761,85 @@ async def generate(message: types.Message, command: CommandObject):
     if not rate_limit(f"generate:{user_id}"):
         return await message.reply("<a href='tg://emoji?id=5924719252379537729'>⏳</a> Слишком часто. Подожди пару секунд.", parse_mode="HTML")
 
-    prompt = urllib.parse.quote_plus(args)
+    file_id = await asyncio.to_thread(image_cache.get, args)
+    if file_id is not None:
+        logger.debug(f"Image cache hit for user {user_id}")
+        return await message.reply_photo(file_id, caption=f"<blockquote expandable><code>{h(args)}</code></blockquote>", parse_mode="HTML")
+
+    job = ImageJob(message, args)
+    position = image_jobs.waiting + 1 if image_jobs.running >= image_jobs.workers else 0
+    job.placeholder = await message.reply(image_job_text(position), parse_mode="HTML", reply_markup=image_job_keyboard(job))
+    try:
+        image_jobs.submit(job)
+    except QueueFull:
+        await job.placeholder.edit_text("<a href='tg://emoji?id=5924719252379537729'>⏳</a> Очередь генерации переполнена, попробуйте позже.", parse_mode="HTML")
+
+
+def image_job_text(position: int) -> str:
+    if position == 0:
+        return "<a href='tg://emoji?id=6026089641730382702'>🖼️</a> <b>Изображение генерируется, подождите...</b>"
+    return f"<a href='tg://emoji?id=6026089641730382702'>🖼️</a> <b>Изображение генерируется, подождите...</b>\nМесто в очереди: <code>{position}</code>"
+
+
+def image_job_keyboard(job: ImageJob) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Отменить", callback_data=f"gen_cancel_{job.id}")]
+    ])
+
+
+async def report_image_job_position(job: ImageJob, position: int):
+    await job.placeholder.edit_text(image_job_text(position), parse_mode="HTML", reply_markup=image_job_keyboard(job))
+
+
+async def run_image_job(job: ImageJob):
+    prompt = urllib.parse.quote_plus(job.prompt)
     img_url = f"https://image.pollinations.ai/prompt/{prompt}"
 
     try:
-        reply = await message.reply("<a href='tg://emoji?id=6026089641730382702'>🖼️</a> <b>Изображение генерируется, подождите...</b>", parse_mode="HTML")
-
-        timeout = aiohttp.ClientTimeout(total=30)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get(img_url) as resp:
-                
-                if resp.status != 200:
-                    error_text = await resp.text()
-                    raise Exception(f"Failed to fetch image. Status: {resp.status}, Response: {error_text[:100]}...")
-
-                content_type = resp.headers.get('Content-Type', '')
-                if 'image/' not in content_type:
-                    raise Exception(f"Received non-image content: {content_type}")
-                    
-                image_bytes = await resp.read()
-
-        await reply.delete()
-
-        await message.reply_photo(
-            types.BufferedInputFile(image_bytes, filename="generated_image.jpg"),
-            caption=f"<blockquote expandable><code>{h(args)}</code></blockquote>",
-            parse_mode="HTML"
-        )
+        async with image_client.fetch(img_url) as resp:
+            sent = await job.message.reply_photo(
+                image_client.stream(resp, filename="generated_image.jpg"),
+                caption=f"<blockquote expandable><code>{h(job.prompt)}</code></blockquote>",
+                parse_mode="HTML"
+            )
+
+        await job.placeholder.delete()
+        if sent.photo:
+            await asyncio.to_thread(image_cache.put, job.prompt, sent.photo[-1].file_id)
+
+    except asyncio.CancelledError:
+        await job.placeholder.edit_text("<a href='tg://emoji?id=5879995903955179148'>🛑</a> Генерация отменена.", parse_mode="HTML")
+        raise
 
     except Exception as e:
-        await reply.delete()
+        await job.placeholder.delete()
             
-        await message.reply(
+        await job.message.reply(
             f"<b>Ошибка при генерации изображения.</b>\n\n<blockquote expandable><code>{e}</code></blockquote>", 
             parse_mode="HTML"
         )
-        logger.exception(f"Image generation error for user {user_id}: {e}")
+        logger.exception(f"Image generation error for user {job.user_id}: {e}")
+
+
+image_jobs = ImageJobQueue(
+    run_image_job, report_image_job_position, workers=cluster.share(IMAGE_WORKERS), max_size=IMAGE_QUEUE_SIZE
+)
+lifecycle.on_drain(image_jobs.drain)
+
+
+@router.callback_query(lambda c: c.data.startswith("gen_cancel"))
+async def gen_cancel(callback: types.CallbackQuery):
+    job_id = int(callback.data.split("_")[2])
+    job = image_jobs.get(job_id)
+    if job is None:
+        await callback.answer("Генерация уже завершена.")
+        return
+    if job.user_id != callback.from_user.id and not is_admin(callback.from_user.id):
+        await callback.answer("Нет прав.", show_alert=True)
+        return
+    if image_jobs.cancel(job_id) and job.position != 0:
+        await job.placeholder.edit_text("<a href='tg://emoji?id=5879995903955179148'>🛑</a> Генерация отменена.", parse_mode="HTML")
+    await callback.answer()
 
 
 @router.message(Command("donate"))
@@ -533,15 +858,17 @@ async def restart(message: types.Message):
         return
     await message.answer("<a href='tg://emoji?id=5877410604225924969'>🔄</a> Restarting bot...", parse_mode="HTML")
     logger.debug(f"{utils.user(message).username} restarted the bot.")
-    await bot.session.close()
-    db.connection.close()
-    os.execl(sys.executable, sys.executable, "-m", "start")
+    await shutdown(restart=True)
 
 
-@router.message()
-async def chat(message: types.Message, state: FSMContext):
+@router.message(flags={"chat_queue": True})
+async def chat(message: types.Message, state: FSMContext, burst: list[types.Message] = None):
     if not is_private_message(message):
         return
+    # ChatQueueMiddleware склеивает сообщения, пришедшие пока бот отвечал; отвечаем на последнее
+    burst = burst or [message]
+    message = burst[-1]
+    text = "\n\n".join(m.text for m in burst if m.text)
     u = utils.user(message)
     current_state = await state.get_state()
 
@@ -556,40 +883,50 @@ async def chat(message: types.Message, state: FSMContext):
         await bot.send_chat_action(message.chat.id, action="typing")
 
         user_message = ""
-        image_data = None
+        image_description = None
+        image_data = image_id = None
 
         if message.photo:
             try:
-                photo = message.photo[-1]
+                photo = pick_photo_size(message.photo, IMAGE_TARGET_SIZE)
+                image_description = await asyncio.to_thread(vision_cache.get, photo.file_unique_id)
+                if image_description is None:
+                    image_data = await prepare_photo(bot, photo, IMAGE_TARGET_SIZE, config.current.image_max_bytes)
+                    image_id = photo.file_unique_id
 
-                img_buffer = io.BytesIO()
-                await bot.download(photo, destination=img_buffer)
+                user_message = message.caption if message.caption else ""
 
-                img_bytes = img_buffer.getvalue()
-                if len(img_bytes) > IMAGE_MAX_BYTES:
-                    return await message.reply("<a href='tg://emoji?id=6019102674832595118'>⚠️</a> Изображение слишком большое.", parse_mode="HTML")
-                image_data = base64.b64encode(img_bytes).decode('utf-8')
+            except ImageTooLarge:
+                return await message.reply("<a href='tg://emoji?id=6019102674832595118'>⚠️</a> Изображение слишком большое.", parse_mode="HTML")
 
-                user_message = message.caption if message.caption else ""
-        
             except Exception as e:
                 logger.exception(f"Failed to process image from user {u.id}: {e}")
                 return await message.reply(f"<a href='tg://emoji?id=5872829476143894491'>🐛</a> <b>Ошибка при обработке изображения, сообщите администрации</b> (/admins)\n\n<blockquote expandable><code>{e}</code></blockquote>", parse_mode="HTML")
-        elif message.text:
-            user_message = message.text
+        elif text:
+            user_message = text
 
         msg_len = len(user_message) if user_message else 0
-        logger.debug(f"Message from (@{u.username}) [{u.id}]: len={msg_len} Image included: {bool(image_data)}")
+        logger.debug(f"Message from (@{u.username}) [{u.id}]: len={msg_len} Image included: {image_description is not None or image_data is not None} Coalesced: {len(burst)}")
 
-        reply_ai = await ask_copilot(message.chat.id, user_message, image_data=image_data)
-        await message.reply(reply_ai, parse_mode="HTML")
+        if AI_STREAMING:
+            streaming = utils.StreamingReply(message, interval=STREAM_EDIT_INTERVAL)
+            reply_ai = await ask_copilot(
+                message.chat.id, user_message, image_description=image_description, on_chunk=streaming.update,
+                image_data=image_data, image_id=image_id,
+            )
+            await streaming.finish(reply_ai)
+        else:
+            reply_ai = await ask_copilot(
+                message.chat.id, user_message, image_description=image_description, image_data=image_data, image_id=image_id
+            )
+            await message.reply(reply_ai, parse_mode="HTML")
 
 
     elif current_state == UserMode.feedback.state:
         fb_text = (
             "<a href='tg://emoji?id=5890741826230423364'>💬</a> Вам пришло сообщение!\n\n"
             f"<a href='tg://emoji?id=5994809115740737538'>🐱</a> От: [@{h(u.username)} / <code>{u.id}</code>]\n"
-            f"<a href='tg://emoji?id=5994495149336434048'>⭐️</a> Сообщение: <b>{h(message.text)}</b>"
+            f"<a href='tg://emoji?id=5994495149336434048'>⭐️</a> Сообщение: <b>{h(text)}</b>"
         )
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [
@@ -617,7 +954,9 @@ async def ap_callbacks(callback: types.CallbackQuery, state: FSMContext):
 
     if action == "clear_memory":
         try:
-            db.clear_global_history()
+            await asyncio.to_thread(db.clear_global_history)
+            maintenance.wake()
+            cluster.broadcast("history_wiped")
             logger.debug("All memory cleared.")
             await callback.answer("🧽 Memory cleared.", show_alert=True)
         except Exception as e:
@@ -626,16 +965,64 @@ async def ap_callbacks(callback: types.CallbackQuery, state: FSMContext):
             await callback.message.answer(f"<a href='tg://emoji?id=6019102674832595118'>⚠️</a> Ошибка при очистке памяти.\n\n<blockquote expandable><code>{e}</code></blockquote>", parse_mode="HTML")
 
     elif action == "stats":
-        users_count, messages_count = db.stats()
+        db_stats = await asyncio.to_thread(db.stats)
+        cache = db.history_cache.stats()
+        limits = limiter.stats()
+        quota = model_quota.stats()
+        tpm_limit = quota['tpm_limit'] or "∞"
+        images = image_cache.stats()
+        vision = vision_cache.stats()
+        jobs = image_jobs.stats()
+        latency = engine.stats()
+        upkeep = maintenance.stats()
+        daily_text = "\n".join(
+            f"• {day}: <code>{users}</code> польз., <code>{messages}</code> сообщ."
+            for day, users, messages in db_stats["daily"]
+        ) or "—"
+        top_text = "\n".join(
+            f"• <code>{user_id}</code>: <code>{sent}</code>" for user_id, sent in db_stats["top"]
+        ) or "—"
+        responses_text = ""
+        if response_cache is not None:
+            responses = response_cache.stats()
+            responses_text = (
+                f"♻️ Кэш ответов: <code>{responses['hit_rate']:.0%}</code> попаданий "
+                f"(<code>{responses['hits']}</code> / <code>{responses['misses']}</code> промахов), "
+                f"сэкономлено <code>{responses['saved_time']:.1f} с</code>\n"
+            )
     
         stats_text = (
-            "📊 Статистика бота:\n\n"
-            f"👤 Активных пользователей: {users_count}\n"
-            f"💬 Сообщений в памяти: {messages_count}\n"
-            f"💾 Тип базы: SQLite3 / v{utils.version()}"
+            "📊 <b>Статистика бота</b>\n\n"
+            f"👤 Активных пользователей: <code>{db_stats['users']}</code>\n"
+            f"💬 Сообщений в памяти: <code>{db_stats['messages']}</code>\n"
+            f"🗄 В архиве: <code>{db_stats['archived']}</code> пользователей\n"
+            f"🗂 Кэш истории: <code>{cache['hit_rate']:.0%}</code> попаданий "
+            f"(<code>{cache['hits']}</code> / <code>{cache['misses']}</code> промахов), "
+            f"<code>{cache['chats']}</code> чатов, <code>{cache['bytes'] / 1024:.0f} KB</code>\n"
+            f"🚦 Лимитер: <code>{limits['allowed']}</code> пропущено, <code>{limits['rejected']}</code> отклонено, "
+            f"<code>{limits['keys']}</code> ключей\n"
+            f"🤖 Модель: <code>{quota['active']}/{quota['max_concurrency']}</code> запросов, "
+            f"<code>{quota['tpm_used']}/{tpm_limit}</code> токенов/мин, "
+            f"ожиданий квоты: <code>{quota['waits']}</code> (<code>{quota['wait_time']:.1f} с</code>)\n"
+            f"⏱ Задержка модели: <code>{latency['p50']:.1f}</code> / <code>{latency['p95']:.1f} с</code> (p50 / p95), "
+            f"<code>{latency['requests']}</code> запросов, <code>{latency['failures']}</code> ошибок\n"
+            f"{responses_text}"
+            f"🖼 Кэш картинок: <code>{images['hit_rate']:.0%}</code> попаданий "
+            f"(<code>{images['hits']}</code> / <code>{images['misses']}</code> промахов)\n"
+            f"👁 Кэш описаний фото: <code>{vision['hit_rate']:.0%}</code> попаданий "
+            f"(<code>{vision['hits']}</code> / <code>{vision['misses']}</code> промахов)\n"
+            f"🎨 Генерация: <code>{jobs['running']}/{jobs['workers']}</code> идёт, <code>{jobs['waiting']}</code> в очереди, "
+            f"<code>{jobs['completed']}</code> готово, <code>{jobs['cancelled']}</code> отменено\n"
+            f"🧹 Обслуживание базы: <code>{upkeep['runs']}</code> проходов, удалено "
+            f"<code>{upkeep['purged']}</code> стёртых / <code>{upkeep['expired']}</code> устаревших / "
+            f"<code>{upkeep['trimmed']}</code> лишних, в архив перенесено <code>{upkeep['archived']}</code>\n"
+            f"💾 Тип базы: SQLite3 / v{utils.version()}\n\n"
+            f"📅 <b>Активность по дням:</b>\n<blockquote expandable>{daily_text}</blockquote>\n"
+            f"🏆 <b>Самые активные:</b>\n<blockquote expandable>{top_text}</blockquote>"
         )
     
-        await callback.answer(stats_text, show_alert=True)
+        await callback.message.answer(stats_text, parse_mode="HTML")
+        await callback.answer()
 
     elif action == "add":
         await callback.message.answer("Введите ID пользователя, которого нужно сделать админом.")
@@ -653,6 +1040,18 @@ async def ap_callbacks(callback: types.CallbackQuery, state: FSMContext):
         await callback.message.answer(f"<b>Admins</b>\n{admins_text}", parse_mode="HTML")
         await callback.answer()
 
+    elif action == "reload":
+        try:
+            changed = config.reload()
+            cluster.broadcast("config_reloaded")
+            logger.debug(f"{user.username} reloaded config, changed: {changed}")
+            text = ", ".join(changed) if changed else "ничего не изменилось"
+            await callback.answer(f"🔁 Config reloaded: {text}", show_alert=True)
+        except Exception as e:
+            logger.exception(f"Failed to reload config: {e}")
+            await callback.answer()
+            await callback.message.answer(f"<a href='tg://emoji?id=6019102674832595118'>⚠️</a> Ошибка при перезагрузке настроек, остались прежние.\n\n<blockquote expandable><code>{e}</code></blockquote>", parse_mode="HTML")
+
     elif action == "logs":
         try:
             files = [f for f in os.listdir("logs") if f.startswith("bot_") and f.endswith(".log")]
@@ -680,14 +1079,10 @@ async def ap_callbacks(callback: types.CallbackQuery, state: FSMContext):
         await callback.message.answer("<a href='tg://emoji?id=5879995903955179148'>🛑</a> Stopping bot...", parse_mode="HTML")
         await callback.answer()
         logger.debug(f"{user.username} stopped the bot.")
-        await bot.session.close()
-        db.connection.close()
-        os._exit(0)
+        await shutdown()
     
     elif action == "restart":
         await callback.message.answer("<a href='tg://emoji?id=5877410604225924969'>🔄</a> Restarting bot...", parse_mode="HTML")
         await callback.answer()
         logger.debug(f"{user.username} restarted the bot.")
-        await bot.session.close()
-        db.connection.close()
-        os.execl(sys.executable, sys.executable, "-m", "start")
+        await shutdown(restart=True)
@@ -0,0 +1,251 @@
+"""Работа с картинками: подготовка фото для модели, загрузка и очередь генерации изображений."""
+import asyncio
+import base64
+import io
+import itertools
+from collections import deque
+from contextlib import asynccontextmanager
+
+import aiohttp
+from aiogram.types import InputFile, Message, PhotoSize
+from loguru import logger
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+class ImageTooLarge(Exception):
+    """Картинка больше допустимого размера."""
+
+
+def pick_photo_size(photos: list[PhotoSize], target: int) -> PhotoSize:
+    """Самый маленький из размеров фото, у которого длинная сторона не меньше target (иначе самый большой)."""
+    for photo in sorted(photos, key=lambda p: p.width * p.height):
+        if max(photo.width, photo.height) >= target:
+            return photo
+    return max(photos, key=lambda p: p.width * p.height)
+
+
+def _encode_photo(buffer: io.BytesIO, target: int) -> str:
+    """Уменьшает картинку до target по длинной стороне (если есть Pillow) и кодирует в base64."""
+    if Image is not None:
+        with Image.open(buffer) as image:
+            if max(image.size) > target:
+                image.thumbnail((target, target))
+                resized = io.BytesIO()
+                image.convert("RGB").save(resized, format="JPEG", quality=85)
+                buffer = resized
+    buffer.seek(0)
+    with buffer.getbuffer() as view:
+        return base64.b64encode(view).decode("ascii")
+
+
+async def prepare_photo(bot, photo: PhotoSize, target: int, max_bytes: int) -> str:
+    """
+    Готовит фото для модели: качает выбранный размер (см. pick_photo_size)
+    в память один раз и кодирует в base64 вне event loop.
+    """
+    if photo.file_size and photo.file_size > max_bytes:
+        raise ImageTooLarge(f"Image is larger than {max_bytes} bytes")
+    buffer = io.BytesIO()
+    await bot.download(photo, destination=buffer)
+    if buffer.getbuffer().nbytes > max_bytes:
+        raise ImageTooLarge(f"Image is larger than {max_bytes} bytes")
+    return await asyncio.to_thread(_encode_photo, buffer, target)
+
+
+class StreamedImage(InputFile):
+    """
+    Отдаёт тело HTTP-ответа в загрузку Telegram кусками, не собирая картинку
+    целиком в памяти. Обрывает загрузку, если размер превысил `max_bytes`.
+    """
+
+    def __init__(self, response: aiohttp.ClientResponse, max_bytes: int, filename: str = "image.jpg", chunk_size: int = 64 * 1024):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.response = response
+        self.max_bytes = max_bytes
+
+    async def read(self, bot):
+        size = 0
+        async for chunk in self.response.content.iter_chunked(self.chunk_size):
+            size += len(chunk)
+            if size > self.max_bytes:
+                raise ImageTooLarge(f"Image is larger than {self.max_bytes} bytes")
+            yield chunk
+
+
+class ImageClient:
+    """Долгоживущая aiohttp-сессия с пулом соединений: открывается на старте бота, закрывается при остановке."""
+
+    def __init__(self, timeout: float = 30.0, connections: int = 8, max_bytes: int = 10 * 1024 * 1024):
+        self.timeout = timeout
+        self.connections = connections
+        self.max_bytes = max_bytes
+        self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                connector=aiohttp.TCPConnector(limit=self.connections),
+            )
+        return self._session
+
+    async def start(self) -> None:
+        self.session
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    @asynccontextmanager
+    async def fetch(self, url: str):
+        """Открывает ответ с картинкой, проверив статус, тип и заявленный размер."""
+        async with self.session.get(url) as resp:
+            if resp.status != 200:
+                error_text = await resp.text()
+                raise Exception(f"Failed to fetch image. Status: {resp.status}, Response: {error_text[:100]}...")
+
+            content_type = resp.headers.get('Content-Type', '')
+            if 'image/' not in content_type:
+                raise Exception(f"Received non-image content: {content_type}")
+
+            if resp.content_length is not None and resp.content_length > self.max_bytes:
+                raise ImageTooLarge(f"Image is larger than {self.max_bytes} bytes")
+
+            yield resp
+
+    def stream(self, resp: aiohttp.ClientResponse, filename: str = "image.jpg") -> StreamedImage:
+        return StreamedImage(resp, self.max_bytes, filename=filename)
+
+
+class QueueFull(Exception):
+    """В очереди генерации нет места."""
+
+
+class ImageJob:
+    _ids = itertools.count(1)
+
+    def __init__(self, message: Message, prompt: str):
+        self.id = next(self._ids)
+        self.message = message
+        self.user_id = message.from_user.id
+        self.prompt = prompt
+        self.placeholder = None
+        self.position = None
+        self.task = None
+
+
+class ImageJobQueue:
+    """
+    Очередь генерации картинок: не больше `workers` генераций одновременно
+    и не больше `max_size` ожидающих задач. `runner(job)` выполняет задачу,
+    `on_position(job, position)` сообщает об изменении места в очереди (0 — задача запущена).
+    """
+
+    def __init__(self, runner, on_position, workers: int = 2, max_size: int = 20):
+        self.runner = runner
+        self.on_position = on_position
+        self.workers = workers
+        self.max_size = max_size
+        self.completed = 0
+        self.cancelled = 0
+        self._waiting: deque = deque()
+        self._running: dict = {}
+        self._wakeup = asyncio.Event()
+        self._tasks: list = []
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiting)
+
+    @property
+    def running(self) -> int:
+        return len(self._running)
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, job: ImageJob) -> int:
+        """Ставит задачу в очередь и возвращает её место (1 — следующая)."""
+        if len(self._waiting) >= self.max_size:
+            raise QueueFull(f"Image queue is full ({self.max_size})")
+        self._waiting.append(job)
+        job.position = len(self._waiting)
+        self._wakeup.set()
+        return job.position
+
+    def get(self, job_id: int):
+        for job in self._waiting:
+            if job.id == job_id:
+                return job
+        return self._running.get(job_id)
+
+    def cancel(self, job_id: int) -> bool:
+        """Убирает задачу из очереди или прерывает уже запущенную."""
+        for job in self._waiting:
+            if job.id == job_id:
+                self._waiting.remove(job)
+                self.cancelled += 1
+                self._report_positions()
+                return True
+        job = self._running.get(job_id)
+        if job is not None and job.task is not None and not job.task.done():
+            job.task.cancel()
+            self.cancelled += 1
+            return True
+        return False
+
+    def _report_positions(self) -> None:
+        for position, job in enumerate(self._waiting, start=1):
+            if job.position != position:
+                job.position = position
+                asyncio.create_task(self._notify(job, position))
+
+    async def _notify(self, job: ImageJob, position: int) -> None:
+        try:
+            await self.on_position(job, position)
+        except Exception as e:
+            logger.debug(f"Failed to report queue position for image job {job.id}: {e}")
+
+    async def _worker(self) -> None:
+        while True:
+            while not self._waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            job = self._waiting.popleft()
+            job.position = 0
+            self._running[job.id] = job
+            self._report_positions()
+            await self._notify(job, 0)
+            job.task = asyncio.create_task(self.runner(job))
+            try:
+                await asyncio.gather(job.task, return_exceptions=True)
+                if not job.task.cancelled():
+                    self.completed += 1
+            finally:
+                del self._running[job.id]
+
+    async def drain(self) -> None:
+        """Ждёт, пока не опустеет очередь и не закончатся запущенные генерации."""
+        while self._waiting or self._running:
+            await asyncio.sleep(0.1)
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict:
+        return {
+            "waiting": len(self._waiting),
+            "running": len(self._running),
+            "workers": self.workers,
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+        }
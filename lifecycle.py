@@ -0,0 +1,112 @@
+"""
+Плавная остановка и перезапуск бота.
+
+Порядок: перестать получать апдейты (остановить polling / отвечать webhook'у 503,
+чтобы Telegram доставил их после перезапуска), дождаться уже
+начатых хендлеров и фоновых задач (не дольше `drain_timeout` секунд),
+закрыть ресурсы (сброс записи в базу, HTTP-пулы) и только потом выйти
+или перезапустить процесс.
+"""
+import asyncio
+import os
+import sys
+
+from loguru import logger
+
+
+class Lifecycle:
+    def __init__(self, drain_timeout: float = 30.0):
+        self.drain_timeout = drain_timeout
+        self.accepting = True
+        self._tasks: set = set()
+        self._stoppers: list = []
+        self._drainers: list = []
+        self._closers: list = []
+        self._stopped = None
+        self._exiting = None
+
+    # ===|Регистрация|===
+    def on_stop(self, func):
+        """Регистрирует корутину, которая останавливает источник апдейтов; вызываются до drain."""
+        self._stoppers.append(func)
+        return func
+
+    def on_drain(self, func):
+        """Регистрирует корутину, которая ждёт завершения фоновой работы (очереди и т.п.)."""
+        self._drainers.append(func)
+        return func
+
+    def on_close(self, func):
+        """Регистрирует корутину закрытия ресурсов; вызываются в порядке регистрации после drain."""
+        self._closers.append(func)
+        return func
+
+    def track(self, task: asyncio.Task) -> None:
+        self._tasks.add(task)
+
+    def untrack(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+
+    @property
+    def inflight(self) -> int:
+        return len(self._tasks)
+
+    # ===|Остановка|===
+    async def drain(self) -> None:
+        """Ждёт начатые хендлеры и фоновые задачи; то, что не успело за drain_timeout, отменяется."""
+        current = asyncio.current_task()
+        pending = [task for task in self._tasks if task is not current and not task.done()]
+        waiters = [asyncio.ensure_future(func()) for func in self._drainers]
+        everything = pending + waiters
+        if not everything:
+            return
+        logger.info(f"Draining {len(pending)} in-flight updates and {len(waiters)} background queues...")
+        done, left = await asyncio.wait(everything, timeout=self.drain_timeout)
+        if left:
+            logger.warning(f"{len(left)} tasks did not finish in {self.drain_timeout}s, cancelling")
+            for task in left:
+                task.cancel()
+            await asyncio.gather(*left, return_exceptions=True)
+
+    async def _stop(self) -> None:
+        self.accepting = False
+        for func in self._stoppers:
+            try:
+                await func()
+            except Exception as e:
+                logger.exception(f"Failed to stop {getattr(func, '__name__', func)}: {e}")
+        await self.drain()
+        for func in self._closers:
+            try:
+                await func()
+            except Exception as e:
+                logger.exception(f"Failed to close {getattr(func, '__name__', func)}: {e}")
+
+    async def stop(self) -> None:
+        """Останавливает приём апдейтов, дожидается работы и закрывает ресурсы (повторный вызов ждёт первый)."""
+        if self._stopped is None:
+            self._stopped = asyncio.ensure_future(self._stop())
+        await asyncio.shield(self._stopped)
+
+    async def _exit(self, restart: bool) -> None:
+        try:
+            await self.stop()
+        finally:
+            if restart:
+                logger.info("Restarting...")
+                os.execl(sys.executable, sys.executable, "-m", "start")
+            logger.info("Stopped")
+            os._exit(0)
+
+    async def wait(self) -> None:
+        """Если остановка запрошена через request, ждёт выхода/перезапуска процесса."""
+        if self._exiting is not None:
+            await self._exiting
+
+    def request(self, restart: bool = False) -> None:
+        """
+        Планирует остановку (или перезапуск) и сразу возвращается, чтобы вызвавший
+        хендлер успел завершиться и не ждал сам себя при drain.
+        """
+        if self._exiting is None:
+            self._exiting = asyncio.create_task(self._exit(restart))
@@ -1,28 +1,121 @@
 # TODO: медиа. системный промпт/ИИ
 
 
+import asyncio
 import os
+import signal
+from aiohttp import web
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from loguru import logger
-from handlers import router
+from handlers import router, db, on_startup, lifecycle
+from middlewares import LifecycleMiddleware
+from storage import SQLiteStorage
 
 
 
 load_dotenv()
-storage = MemoryStorage()
+
+# BOT_MODE=polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# False — после перезапуска обработать накопившиеся апдейты, а не выбросить их
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "1") == "1"
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+
+
+def create_storage():
+    """FSM_REDIS_URL — общий Redis для нескольких процессов, иначе состояния хранятся в memory.db."""
+    redis_url = os.getenv("FSM_REDIS_URL")
+    if redis_url:
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(redis_url)
+    return SQLiteStorage(db)
+
+
+storage = create_storage()
 dp = Dispatcher(storage=storage)
+dp.startup.register(on_startup)
+# во время остановки новые апдейты не принимаются, а начатые дожидаются (см. lifecycle.py)
+dp.update.outer_middleware(LifecycleMiddleware(lifecycle))
 bot = Bot(token=os.getenv("BOT_TOKEN"))
 
 os.makedirs("logs", exist_ok=True)
 logger.add("logs/bot_{time}.log", level="DEBUG", rotation="10 MB", retention="1 month", compression="gz")
 
+async def health(request: web.Request) -> web.Response:
+    return web.json_response({"status": "ok", "mode": BOT_MODE})
+
+
+async def run_webhook():
+    if not WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL is required when BOT_MODE=webhook")
+
+    @web.middleware
+    async def refuse_when_stopping(request: web.Request, handler):
+        # пока дожидаемся начатых ответов, Telegram получает 503 и повторит апдейт уже новому процессу
+        if not lifecycle.accepting:
+            return web.Response(status=503)
+        return await handler(request)
+
+    app = web.Application(middlewares=[refuse_when_stopping])
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    app.router.add_get("/health", health)
+    setup_application(app, dp, bot=bot)
+
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        drop_pending_updates=DROP_PENDING_UPDATES,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host=WEBHOOK_HOST, port=WEBHOOK_PORT).start()
+    logger.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    # в polling-режиме сигналы ловит aiogram; здесь сами, иначе в Docker (PID 1) SIGTERM игнорируется
+    # и docker stop убивает процесс вместе с начатыми ответами и несохранённой историей
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, lifecycle.request, False)
+        except NotImplementedError:
+            pass  # Windows
+    try:
+        await asyncio.Event().wait()
+    finally:
+        # on_shutdown приложения закрывает сессию бота, поэтому сначала дожидаемся ответов
+        await lifecycle.stop()
+        await runner.cleanup()
+
+
+async def stop_polling():
+    try:
+        await dp.stop_polling()
+    except RuntimeError:
+        pass  # polling уже остановлен (например, сигналом)
+
+
 async def main():
     try:
-        logger.info("Starting bot...")
-        await bot.delete_webhook(drop_pending_updates=True)
+        logger.info(f"Starting bot ({BOT_MODE})...")
         dp.include_router(router)
-        await dp.start_polling(bot)
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
+            # при /stop и /restart новые апдейты не забираются, пока дожидаемся начатых
+            lifecycle.on_stop(stop_polling)
+            # сессию закрываем сами: после сигнала остановки ещё дожидаемся начатых ответов
+            await dp.start_polling(bot, close_bot_session=False)
     except Exception as e:
-        logger.exception(f"Unknown error while stoping from panel: {e}")
\ No newline at end of file
+        logger.exception(f"Unknown error while stoping from panel: {e}")
+    finally:
+        await lifecycle.stop()
+        await bot.session.close()
+        await lifecycle.wait()
@@ -0,0 +1,159 @@
+"""
+Фоновое обслуживание базы: дочистка стёртой истории, политики хранения,
+перенос истории неактивных пользователей в архив и возврат освободившегося места файлу.
+
+Всё удаление идёт небольшими порциями в отдельном потоке, между порциями
+блокировка базы отпускается, поэтому запись сообщений чатов не ждёт.
+"""
+import asyncio
+import datetime
+import time
+
+from loguru import logger
+
+from database import Database
+
+
+class Maintenance:
+    """
+    retention_days — удалять сообщения старше N дней (0 — не удалять),
+    max_rows_per_user — держать в истории не больше N сообщений пользователя (0 — без лимита),
+    archive_after_days — переносить в архив историю тех, кто молчит N дней (0 — не переносить),
+    on_archived(user_ids) — вызывается после переноса (например, чтобы сообщить другим процессам),
+    scheduled — чистить общие таблицы (daily_users; в многопроцессном режиме только в одном воркере),
+    shard — (номер, число воркеров): политики хранения и архивация только для своих чатов
+    (см. Database.delete_expired, Database.inactive_users). Проход идёт в каждом процессе раз в `interval` секунд.
+    """
+
+    def __init__(self, db: Database, interval: float = 3600, retention_days: int = 0, max_rows_per_user: int = 0,
+                 chunk_size: int = 500, vacuum_pages: int = 1000, daily_users_days: int = 30,
+                 pause: float = 0.05, scheduled: bool = True, archive_after_days: int = 0,
+                 archive_batch: int = 100, on_archived=None, shard=None):
+        self.db = db
+        self.interval = interval
+        self.retention_days = retention_days
+        self.max_rows_per_user = max_rows_per_user
+        self.chunk_size = chunk_size
+        self.vacuum_pages = vacuum_pages
+        self.daily_users_days = daily_users_days
+        self.pause = pause
+        self.scheduled = scheduled
+        self.archive_after_days = archive_after_days
+        self.archive_batch = archive_batch
+        self.on_archived = on_archived
+        self.shard = shard
+        self.runs = 0
+        self.purged = 0
+        self.expired = 0
+        self.trimmed = 0
+        self.archived = 0
+        self.last_run = None
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    def wake(self) -> None:
+        """Запускает проход вне расписания (например, сразу после стирания всей истории)."""
+        self._wake.set()
+
+    async def _loop(self) -> None:
+        # первым делом дочищаем то, что не успели до прошлого перезапуска
+        self._wake.set()
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.run()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Database maintenance failed: {e}")
+
+    async def _in_chunks(self, func, *args, **kwargs) -> int:
+        """Вызывает func(*args, chunk_size, **kwargs) в потоке, пока она удаляет полные порции."""
+        total = 0
+        while True:
+            deleted = await asyncio.to_thread(func, *args, self.chunk_size, **kwargs)
+            total += deleted
+            if deleted < self.chunk_size:
+                return total
+            await asyncio.sleep(self.pause)
+
+    async def run(self) -> None:
+        """Один проход обслуживания."""
+        started = time.monotonic()
+        purged = expired = trimmed = archived = 0
+        for table in await asyncio.to_thread(self.db.wiped_tables):
+            purged += await self._in_chunks(self.db.purge_wiped, table)
+
+        # политики хранения, как и архивация, — каждый процесс для своих чатов, чтобы сбросить свой кэш истории
+        if self.retention_days:
+            before = int(time.time()) - self.retention_days * 86400
+            expired = await self._in_chunks(self.db.delete_expired, before, shard=self.shard)
+        if self.max_rows_per_user:
+            trimmed = await self._in_chunks(self.db.trim_users, self.max_rows_per_user, shard=self.shard)
+
+        if self.scheduled:
+            before_day = (datetime.date.today() - datetime.timedelta(days=self.daily_users_days)).isoformat()
+            await asyncio.to_thread(self.db.prune_daily_users, before_day)
+
+        if self.archive_after_days and self.db.archive_file:
+            archived = await self.archive_inactive()
+
+        free = await asyncio.to_thread(self.db.incremental_vacuum, self.vacuum_pages)
+        while free:
+            await asyncio.sleep(self.pause)
+            left = await asyncio.to_thread(self.db.incremental_vacuum, self.vacuum_pages)
+            if left >= free:
+                break
+            free = left
+
+        self.runs += 1
+        self.purged += purged
+        self.expired += expired
+        self.trimmed += trimmed
+        self.archived += archived
+        self.last_run = time.time()
+        if purged or expired or trimmed or archived:
+            logger.info(
+                f"Database maintenance: {purged} wiped, {expired} expired, {trimmed} trimmed rows removed, "
+                f"{archived} archived "
+                f"in {time.monotonic() - started:.1f}s"
+            )
+
+    async def archive_inactive(self) -> int:
+        """Переносит в архив историю пользователей, которые молчат дольше archive_after_days."""
+        before = int(time.time()) - self.archive_after_days * 86400
+        users = await asyncio.to_thread(self.db.inactive_users, before, self.archive_batch, self.shard)
+        moved = 0
+        for user_id in users:
+            moved += await asyncio.to_thread(self.db.archive_user, user_id, self.chunk_size)
+            await asyncio.sleep(self.pause)
+        if users and self.on_archived is not None:
+            self.on_archived(users)
+        return moved
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "purged": self.purged,
+            "expired": self.expired,
+            "trimmed": self.trimmed,
+            "archived": self.archived,
+            "last_run": self.last_run,
+        }
@@ -0,0 +1,109 @@
+"""Мидлвари роутера."""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import Message
+
+
+def _is_plain_text(message: Message) -> bool:
+    return bool(message.text) and not message.text.startswith("/")
+
+
+def _mark_dispatched(data: Dict[str, Any]) -> None:
+    # в многопроцессном режиме следующий апдейт чата ждёт этого события (см. cluster._feed)
+    dispatched = data.get("dispatched")
+    if dispatched is not None:
+        dispatched.set()
+
+
+class _ChatQueue:
+    __slots__ = ("lock", "burst", "waiting")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.burst = None
+        self.waiting = 0
+
+
+class ChatQueueMiddleware(BaseMiddleware):
+    """
+    Хендлеры с флагом `chat_queue` выполняются строго по одному на чат и в порядке прихода.
+    Текстовые сообщения, пришедшие пока чат занят, склеиваются в одну пачку:
+    хендлер вызывается один раз для первого из них, а все сообщения пачки
+    лежат в `burst`. `coalesce_window` — сколько дополнительно ждать продолжения пачки.
+    """
+
+    def __init__(self, coalesce_window: float = 0.0):
+        self.coalesce_window = coalesce_window
+        self._chats: Dict[int, _ChatQueue] = {}
+
+    async def __call__(
+        self,
+        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
+        event: Message,
+        data: Dict[str, Any],
+    ) -> Any:
+        if not get_flag(data, "chat_queue") or not isinstance(event, Message):
+            return await handler(event, data)
+
+        chat_id = event.chat.id
+        chat = self._chats.setdefault(chat_id, _ChatQueue())
+        chat.waiting += 1
+        try:
+            if _is_plain_text(event):
+                if chat.burst is not None:
+                    chat.burst.append(event)
+                    _mark_dispatched(data)
+                    return None
+                burst = chat.burst = [event]
+            else:
+                # не-текст закрывает пачку, чтобы следующие сообщения не обогнали его
+                burst = [event]
+                chat.burst = None
+
+            # место в очереди чата (очередь asyncio.Lock честная) занимается до первого await,
+            # поэтому следующий апдейт уже можно пускать: он встанет за этим
+            _mark_dispatched(data)
+            async with chat.lock:
+                # ожидание продолжения пачки — уже на своём месте в очереди: фото или команда,
+                # пришедшие за это время, закроют пачку и выполнятся после неё
+                if self.coalesce_window and chat.burst is burst:
+                    await asyncio.sleep(self.coalesce_window)
+                if chat.burst is burst:
+                    chat.burst = None
+                data["burst"] = burst
+                return await handler(event, data)
+        finally:
+            chat.waiting -= 1
+            if not chat.waiting:
+                del self._chats[chat_id]
+
+
+class LifecycleMiddleware(BaseMiddleware):
+    """
+    Внешняя мидлварь апдейтов: учитывает выполняющиеся апдейты в `lifecycle`.
+    Источник апдейтов останавливается раньше drain (см. lifecycle.py), поэтому
+    отбрасываются только апдейты, уже полученные в момент остановки.
+    """
+
+    def __init__(self, lifecycle):
+        self.lifecycle = lifecycle
+        self.dropped = 0
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+    ) -> Any:
+        if not self.lifecycle.accepting:
+            self.dropped += 1
+            return None
+        task = asyncio.current_task()
+        self.lifecycle.track(task)
+        try:
+            return await handler(event, data)
+        finally:
+            self.lifecycle.untrack(task)
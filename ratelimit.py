@@ -0,0 +1,122 @@
+"""Ограничители частоты: на пользователя (token bucket) и общая квота на endpoint модели."""
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+
+class TokenBucketLimiter:
+    """
+    Token bucket на ключ: `rate` жетонов в секунду, не больше `capacity` подряд.
+    Полностью восстановившиеся корзины удаляются раз в `sweep_interval` секунд —
+    для них это то же самое, что новая корзина, так что память не растёт с числом пользователей.
+    """
+
+    def __init__(self, rate: float, capacity: float, sweep_interval: float = 60.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.sweep_interval = sweep_interval
+        self.allowed = 0
+        self.rejected = 0
+        self._buckets: dict = {}  # key -> [tokens, updated_at]
+        self._last_sweep = time.monotonic()
+
+    def _refill(self, bucket, now: float) -> float:
+        return min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+
+    def hit(self, key, cost: float = 1.0) -> bool:
+        now = time.monotonic()
+        if now - self._last_sweep >= self.sweep_interval:
+            self.sweep(now)
+        bucket = self._buckets.get(key)
+        tokens = self.capacity if bucket is None else self._refill(bucket, now)
+        if tokens < cost:
+            self._buckets[key] = [tokens, now]
+            self.rejected += 1
+            return False
+        self._buckets[key] = [tokens - cost, now]
+        self.allowed += 1
+        return True
+
+    def sweep(self, now: float = None) -> None:
+        now = time.monotonic() if now is None else now
+        full = [key for key, bucket in self._buckets.items() if self._refill(bucket, now) >= self.capacity]
+        for key in full:
+            del self._buckets[key]
+        self._last_sweep = now
+
+    def stats(self) -> dict:
+        return {"keys": len(self._buckets), "allowed": self.allowed, "rejected": self.rejected}
+
+
+class ModelQuota:
+    """
+    Общая квота на endpoint модели: не больше `max_concurrency` запросов одновременно
+    и не больше `tokens_per_minute` токенов за скользящую минуту (0 — без лимита).
+    Запрос, не влезающий в квоту, ждёт, а не получает 429 от апстрима.
+    """
+
+    WINDOW = 60.0
+
+    def __init__(self, max_concurrency: int, tokens_per_minute: int = 0):
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.active = 0
+        self.requests = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._window = deque()  # (время, токены)
+        self._used = 0
+
+    def _expire(self, now: float) -> None:
+        while self._window and now - self._window[0][0] >= self.WINDOW:
+            self._used -= self._window.popleft()[1]
+
+    async def _reserve(self, tokens: int) -> None:
+        if not self.tokens_per_minute:
+            return
+        tokens = min(tokens, self.tokens_per_minute)
+        started = time.monotonic()
+        waited = False
+        while True:
+            now = time.monotonic()
+            self._expire(now)
+            if self._used + tokens <= self.tokens_per_minute:
+                break
+            waited = True
+            await asyncio.sleep(self._window[0][0] + self.WINDOW - now)
+        self._window.append((time.monotonic(), tokens))
+        self._used += tokens
+        if waited:
+            self.waits += 1
+            self.wait_time += time.monotonic() - started
+
+    def record(self, tokens: int) -> None:
+        """Досписывает токены, если реальный расход оказался больше зарезервированного."""
+        if self.tokens_per_minute and tokens > 0:
+            self._window.append((time.monotonic(), tokens))
+            self._used += tokens
+
+    @asynccontextmanager
+    async def acquire(self, tokens: int = 0):
+        async with self._semaphore:
+            await self._reserve(tokens)
+            self.active += 1
+            self.requests += 1
+            try:
+                yield
+            finally:
+                self.active -= 1
+
+    def stats(self) -> dict:
+        self._expire(time.monotonic())
+        return {
+            "active": self.active,
+            "max_concurrency": self.max_concurrency,
+            "requests": self.requests,
+            "waits": self.waits,
+            "wait_time": self.wait_time,
+            "tpm_used": self._used,
+            "tpm_limit": self.tokens_per_minute,
+        }
@@ -1,6 +1,7 @@
 """Module entrypoint so users can run `python -m start`.
 
-This file delegates to `main.main()` and runs it via asyncio.
+This file delegates to `main.main()` and runs it via asyncio, or to
+`cluster.run_supervisor()` when BOT_WORKERS > 1.
 """
 import asyncio
 import sys
@@ -22,7 +23,12 @@ except Exception as e:
 
 
 def _run():
-    asyncio.run(app_main())
+    workers = int(os.getenv("BOT_WORKERS", "1"))
+    if workers > 1:
+        from cluster import run_supervisor
+        run_supervisor(workers)
+    else:
+        asyncio.run(app_main())
 
 
 if __name__ == "__main__":
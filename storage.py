@@ -0,0 +1,72 @@
+"""FSM-хранилище aiogram поверх базы бота: переживает /restart и общее для всех процессов."""
+import asyncio
+import json
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from database import Database
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Состояния и данные FSM лежат в таблице `fsm`, чтение идёт через
+    LRU-кэш в памяти, запись — сразу в базу (write-through).
+    """
+
+    def __init__(self, db: Database, cache_size: int = 10000):
+        self.db = db
+        self.cache_size = cache_size
+        self._cache: OrderedDict = OrderedDict()  # key -> [state, data]
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part) for part in (
+            key.bot_id,
+            key.chat_id,
+            key.user_id,
+            key.thread_id or "",
+            getattr(key, "business_connection_id", None) or "",
+            key.destiny,
+        ))
+
+    async def _entry(self, key: str) -> list:
+        entry = self._cache.get(key)
+        if entry is None:
+            row = await asyncio.to_thread(self.db.get_fsm, key)
+            entry = [row[0], json.loads(row[1]) if row[1] else {}] if row else [None, {}]
+            self._cache[key] = entry
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+        return entry
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = self._key(key)
+        entry = await self._entry(k)
+        state = state.state if isinstance(state, State) else state
+        if entry[0] == state:
+            return
+        entry[0] = state
+        await asyncio.to_thread(self.db.set_fsm_state, k, state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._entry(self._key(key)))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        k = self._key(key)
+        entry = await self._entry(k)
+        data = dict(data)
+        if entry[1] == data:
+            return
+        entry[1] = data
+        await asyncio.to_thread(self.db.set_fsm_data, k, json.dumps(data, ensure_ascii=False))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict((await self._entry(self._key(key)))[1])
+
+    async def close(self) -> None:
+        self._cache.clear()
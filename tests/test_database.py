@@ -0,0 +1,15 @@
+from database import Database
+
+
+def test_first_message_counts_as_activity(tmp_path):
+    db = Database(str(tmp_path / "memory.db"))
+    db.add_message(1, "user", "привет")
+    db.flush()
+
+    sent, last_active = db.connection.execute(
+        "SELECT sent, last_active FROM user_stats WHERE user_id = 1"
+    ).fetchone()
+    assert sent == 1
+    assert last_active is not None
+    assert db.stats()["top"] == [(1, 1)]
+    db.close()
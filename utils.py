@@ -1,9 +1,14 @@
+import asyncio
+import html
 import random
 import os
+import re
 from aiogram import types
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
 import datetime
 import time
 from dotenv import load_dotenv
+from loguru import logger
 
 load_dotenv()
 
@@ -33,3 +38,110 @@ def format_timedelta(td: datetime.timedelta) -> str:
 
 def version():
     return f"0.5.7-beta"
+
+
+_TAG_RE = re.compile(r"<(/?)([a-zA-Z][\w-]*)[^>]*>")
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def close_html(text: str) -> str:
+    """
+    Делает кусок HTML безопасным для parse_mode="HTML": отрезает недописанный
+    тег/сущность в конце и закрывает все открытые теги.
+    """
+    lt = text.rfind("<")
+    if lt > text.rfind(">"):
+        text = text[:lt]
+    amp = text.rfind("&")
+    if amp != -1 and len(text) - amp <= 10 and ";" not in text[amp:]:
+        text = text[:amp]
+
+    stack = []
+    for closing, name in _TAG_RE.findall(text):
+        name = name.lower()
+        if not closing:
+            stack.append(name)
+        elif name in stack:
+            while stack.pop() != name:
+                pass
+    return text + "".join(f"</{name}>" for name in reversed(stack))
+
+
+def strip_html(text: str) -> str:
+    """Текст без HTML-разметки — запасной вариант, если Telegram не принял разметку."""
+    return html.unescape(_TAG_RE.sub("", text))
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list[str]:
+    """Режет длинный текст на куски не длиннее `limit`, по возможности по переносам строк."""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text or not chunks:
+        chunks.append(text)
+    return chunks
+
+
+class StreamingReply:
+    """Один ответ, который постепенно дописывается через edit_text (не чаще interval секунд)."""
+
+    def __init__(self, message: types.Message, interval: float = 1.0):
+        self.message = message
+        self.interval = interval
+        self.sent: types.Message | None = None
+        self._parts: list[str] = []
+        self._shown = ""
+        self._last_edit = 0.0
+
+    async def _show(self, text: str) -> None:
+        if not text.strip() or text == self._shown:
+            return
+        try:
+            if self.sent is None:
+                self.sent = await self.message.reply(text, parse_mode="HTML")
+            else:
+                await self.sent.edit_text(text, parse_mode="HTML")
+            self._shown = text
+        except TelegramAPIError as e:
+            # промежуточная правка (flood control, плохая разметка) не должна обрывать генерацию
+            logger.debug(f"Skipped partial reply update: {e}")
+        self._last_edit = time.monotonic()
+
+    async def update(self, delta: str) -> None:
+        self._parts.append(delta)
+        if self.sent is not None and time.monotonic() - self._last_edit < self.interval:
+            return
+        text = "".join(self._parts)
+        if len(text) > TELEGRAM_MESSAGE_LIMIT - 100:
+            text = text[:TELEGRAM_MESSAGE_LIMIT - 100]
+        await self._show(close_html(text) + " ▍")
+
+    async def _deliver(self, text: str, edit: bool) -> None:
+        """Отправляет (или дописывает в self.sent) кусок итогового ответа: HTML, при отказе — простым текстом."""
+        for parse_mode in ("HTML", None):
+            body = text if parse_mode else strip_html(text)
+            for _ in range(2):
+                try:
+                    if edit:
+                        await self.sent.edit_text(body, parse_mode=parse_mode)
+                    else:
+                        self.sent = await self.message.reply(body, parse_mode=parse_mode)
+                    return
+                except TelegramRetryAfter as e:
+                    await asyncio.sleep(e.retry_after)
+                except TelegramBadRequest as e:
+                    if "message is not modified" in str(e):
+                        return
+                    logger.debug(f"Reply rejected with parse_mode={parse_mode}: {e}")
+                    break
+
+    async def finish(self, text: str) -> None:
+        """Итоговый ответ: заменяет промежуточный (с курсором), длинный делится на несколько сообщений."""
+        if self.sent is not None and text == self._shown:
+            return
+        for i, chunk in enumerate(split_message(text)):
+            await self._deliver(chunk, edit=i == 0 and self.sent is not None)